@@ -8,6 +8,7 @@ image on those coordinates then displays the sub-images and records
 a subjective score for each image. See README.org for usage.
 
 """
+from __future__ import print_function
 
 
 ###########################################################################
@@ -59,6 +60,11 @@ TABLE_STYLE_THINBORDER = "border: 1px solid #000000; border-collapse: collapse;"
 #TABLE_STYLE_THINBORDER = "border: 1px solid #000000;"
 
 
+# Attributes of a cell that can also be set for a whole column, in the
+# order they are written
+CELL_ATTRIBS = ('bgcolor', 'width', 'align', 'char', 'charoff', 'valign', 'style')
+
+
 #=== CLASSES ===================================================================
 
 class TableCell (object):
@@ -98,18 +104,17 @@ class TableCell (object):
         if attribs==None:
             self.attribs = {}
 
-    def __str__(self):
-        """return the HTML code for the table cell as a string"""
-        attribs_str = ""
-        if self.bgcolor: self.attribs['bgcolor'] = self.bgcolor
-        if self.width:   self.attribs['width']   = self.width
-        if self.align:   self.attribs['align']   = self.align
-        if self.char:    self.attribs['char']    = self.char
-        if self.charoff: self.attribs['charoff'] = self.charoff
-        if self.valign:  self.attribs['valign']  = self.valign
-        if self.style:   self.attribs['style']   = self.style
-        for attr in self.attribs:
-            attribs_str += ' %s="%s"' % (attr, self.attribs[attr])
+    def render(self, column=None):
+        """return the HTML code for the table cell as a string.
+        column is a dict of attributes for the cell's column, used for
+        the attributes that aren't set on the cell itself."""
+        pairs = []
+        for name in CELL_ATTRIBS:
+            value = getattr(self, name)
+            if value is None and column:
+                value = column.get(name)
+            pairs.append((name, value))
+        attribs_str = attribs_string(merge_attribs(self.attribs, pairs))
         if self.text:
             text = str(self.text)
         else:
@@ -120,6 +125,10 @@ class TableCell (object):
         else:
             return '  <TD%s>%s</TD>\n' % (attribs_str, text)
 
+    def __str__(self):
+        """return the HTML code for the table cell as a string"""
+        return self.render()
+
 #-------------------------------------------------------------------------------
 
 class TableRow (object):
@@ -153,32 +162,88 @@ class TableRow (object):
         if attribs==None:
             self.attribs = {}
 
+    def columns(self, table=None):
+        """return the Columns of the row. Column settings that aren't set
+        on the row are taken from table."""
+        names = ('col_align', 'col_char', 'col_charoff', 'col_valign', 'col_styles')
+        values = []
+        for name in names:
+            value = getattr(self, name)
+            if not value and table is not None:
+                value = getattr(table, name)
+            values.append(value)
+        return Columns(*values)
+
+    def render(self, columns=None):
+        """return the HTML code for the table row as a string. columns are
+        the precomputed Columns of the table, see Table.row"""
+        if columns is None:
+            columns = self.columns()
+        attribs = merge_attribs(self.attribs, [('bgcolor', self.bgcolor)])
+        result = [' <TR%s>\n' % attribs_string(attribs)]
+        if self.header: tag = 'TH'
+        else:           tag = 'TD'
+        for col, cell in enumerate(self.cells):
+            if isinstance(cell, TableCell):
+                result.append(cell.render(columns.attribs(col)))
+            else:
+                # plain cells just take the attributes of their column
+                if cell:
+                    text = str(cell)
+                else:
+                    text = '&nbsp;'
+                result.append('  <%s%s>%s</%s>\n' % (tag, columns.string(col), text, tag))
+        result.append(' </TR>\n')
+        return ''.join(result)
+
+    def has_columns(self):
+        return bool(self.col_align or self.col_char or self.col_charoff
+                    or self.col_valign or self.col_styles)
+
     def __str__(self):
         """return the HTML code for the table row as a string"""
-        attribs_str = ""
-        if self.bgcolor: self.attribs['bgcolor'] = self.bgcolor
-        for attr in self.attribs:
-            attribs_str += ' %s="%s"' % (attr, self.attribs[attr])
-        result = ' <TR%s>\n' % attribs_str
-        for cell in self.cells:
-            col = self.cells.index(cell)    # cell column index
-            if not isinstance(cell, TableCell):
-                cell = TableCell(cell, header=self.header)
-            # apply column alignment if specified:
-            if self.col_align and cell.align==None:
-                cell.align = self.col_align[col]
-            if self.col_char and cell.char==None:
-                cell.char = self.col_char[col]
-            if self.col_charoff and cell.charoff==None:
-                cell.charoff = self.col_charoff[col]
-            if self.col_valign and cell.valign==None:
-                cell.valign = self.col_valign[col]
-            # apply column style if specified:
-            if self.col_styles and cell.style==None:
-                cell.style = self.col_styles[col]
-            result += str(cell)
-        result += ' </TR>\n'
-        return result
+        return self.render()
+
+#-------------------------------------------------------------------------------
+
+class Columns (object):
+    """
+    the attributes of each column of a table, computed once so that they
+    don't have to be looked up again for every cell.
+
+    Attributes:
+    - col_align, col_char, col_charoff, col_valign, col_styles: see Table class
+    """
+
+    def __init__(self, col_align=None, col_char=None, col_charoff=None,
+                 col_valign=None, col_styles=None):
+        """Columns constructor"""
+        self.columns = []
+        for name, values in (('align', col_align), ('char', col_char),
+                             ('charoff', col_charoff), ('valign', col_valign),
+                             ('style', col_styles)):
+            if not values:
+                continue
+            for col, value in enumerate(values):
+                while len(self.columns) <= col:
+                    self.columns.append({})
+                if value is not None:
+                    self.columns[col][name] = value
+        self.strings = [attribs_string([(name, column[name]) for name in CELL_ATTRIBS
+                                        if column.get(name)])
+                        for column in self.columns]
+
+    def attribs(self, col):
+        """return a dict of the attributes of column col"""
+        if col < len(self.columns):
+            return self.columns[col]
+        return None
+
+    def string(self, col):
+        """return the attributes of column col as a string for a TD/TH tag"""
+        if col < len(self.strings):
+            return self.strings[col]
+        return ''
 
 #-------------------------------------------------------------------------------
 
@@ -227,46 +292,61 @@ class Table (object):
         self.col_charoff = col_charoff
         self.col_valign  = col_valign
         self.col_styles  = col_styles
+        self.columns     = None
 
-    def __str__(self):
-        """return the HTML code for the table as a string"""
-        attribs_str = ""
-        if self.border: self.attribs['border'] = self.border
-        if self.style:  self.attribs['style'] = self.style
-        if self.width:  self.attribs['width'] = self.width
-        if self.cellspacing:  self.attribs['cellspacing'] = self.cellspacing
-        if self.cellpadding:  self.attribs['cellpadding'] = self.cellpadding
-        for attr in self.attribs:
-            attribs_str += ' %s="%s"' % (attr, self.attribs[attr])
-        result = '<TABLE%s>\n' % attribs_str
+    def head(self):
+        """return the HTML code that opens the table, up to the data rows"""
+        attribs = merge_attribs(self.attribs,
+            [(name, getattr(self, name)) for name in
+             ('border', 'style', 'width', 'cellspacing', 'cellpadding')])
+        result = ['<TABLE%s>\n' % attribs_string(attribs)]
         # insert column tags and attributes if specified:
         if self.col_width:
             for width in self.col_width:
-                result += '  <COL width="%s">\n' % width
+                result.append('  <COL width="%s">\n' % width)
         if self.header_row:
             if not isinstance(self.header_row, TableRow):
-                result += str(TableRow(self.header_row, header=True))
+                result.append(str(TableRow(self.header_row, header=True)))
             else:
-                result += str(self.header_row)
-        # Then all data rows:
+                result.append(str(self.header_row))
+        # the column attributes are computed once for all the data rows
+        self.columns = Columns(self.col_align, self.col_char, self.col_charoff,
+                               self.col_valign, self.col_styles)
+        return ''.join(result)
+
+    def row(self, row):
+        """return the HTML code for one data row of the table"""
+        if self.columns is None:
+            self.columns = Columns(self.col_align, self.col_char, self.col_charoff,
+                                   self.col_valign, self.col_styles)
+        if not isinstance(row, TableRow):
+            row = TableRow(row)
+        # apply column alignments  and styles to each row if specified:
+        # (Mozilla bug workaround)
+        if row.has_columns():
+            return row.render(row.columns(self))
+        return row.render(self.columns)
+
+    def tail(self):
+        """return the HTML code that closes the table"""
+        return '</TABLE>'
+
+    def lines(self):
+        """yield the HTML code for the table one row at a time"""
+        yield self.head()
         for row in self.rows:
-            if not isinstance(row, TableRow):
-                row = TableRow(row)
-            # apply column alignments  and styles to each row if specified:
-            # (Mozilla bug workaround)
-            if self.col_align and not row.col_align:
-                row.col_align = self.col_align
-            if self.col_char and not row.col_char:
-                row.col_char = self.col_char
-            if self.col_charoff and not row.col_charoff:
-                row.col_charoff = self.col_charoff
-            if self.col_valign and not row.col_valign:
-                row.col_valign = self.col_valign
-            if self.col_styles and not row.col_styles:
-                row.col_styles = self.col_styles
-            result += str(row)
-        result += '</TABLE>'
-        return result
+            yield self.row(row)
+        yield self.tail()
+
+    def write(self, out):
+        """write the HTML code for the table to a file, one row at a time.
+        rows may be any iterable, e.g. a generator."""
+        for line in self.lines():
+            out.write(line)
+
+    def __str__(self):
+        """return the HTML code for the table as a string"""
+        return ''.join(self.lines())
 
 
 #-------------------------------------------------------------------------------
@@ -299,21 +379,35 @@ class List (object):
 
     def __str__(self):
         """return the HTML code for the list as a string"""
-        attribs_str = ""
-        if self.start:  self.attribs['start'] = self.start
-        for attr in self.attribs:
-            attribs_str += ' %s="%s"' % (attr, self.attribs[attr])
+        attribs = merge_attribs(self.attribs, [('start', self.start)])
         if self.ordered: tag = 'OL'
         else:            tag = 'UL'
-        result = '<%s%s>\n' % (tag, attribs_str)
+        result = ['<%s%s>\n' % (tag, attribs_string(attribs))]
         for line in self.lines:
-            result += ' <LI>%s\n' % str(line)
-        result += '</%s>\n' % tag
-        return result
+            result.append(' <LI>%s\n' % str(line))
+        result.append('</%s>\n' % tag)
+        return ''.join(result)
 
 
 #=== FUNCTIONS ================================================================
 
+def merge_attribs(attribs, pairs):
+    """return the items of the dict attribs as (name, value) pairs, with the
+    pairs that have a value replacing them or added after them"""
+    merged = {}
+    merged.update(attribs)
+    names = [name for name in attribs]
+    for name, value in pairs:
+        if value:
+            if name not in merged:
+                names.append(name)
+            merged[name] = value
+    return [(name, merged[name]) for name in names]
+
+def attribs_string(attribs):
+    'return (name, value) pairs as a string of attributes for an HTML tag'
+    return ''.join([' %s="%s"' % (name, value) for name, value in attribs])
+
 # much simpler definition of a link as a function:
 def Link(text, url):
     return '<a href="%s">%s</a>' % (url, text)
@@ -336,319 +430,2738 @@ def list(*args, **kwargs):
 
 
 
-import csv, os, sys
-import ij.IJ
-import ij.gui
-import ij.io
-from ij.io import FileSaver
-from ij import IJ, ImagePlus, WindowManager
-from ij.gui import Roi, Overlay, GenericDialog
-from java.awt.event import KeyEvent, KeyAdapter, ActionListener, WindowAdapter
-from javax.swing import JScrollPane, JPanel, JComboBox, JLabel, JFrame, JButton, JFormattedTextField, JTextField, JFileChooser
-from java.awt import Color, GridLayout
-from random import shuffle, choice
-from java.io import File
+import argparse, csv, getpass, hashlib, heapq, json, os, struct, sys, tempfile, threading, time, zlib
+from random import choice, Random
+from array import array
+try:
+    import ij.IJ
+    import ij.gui
+    import ij.io
+    from ij.io import FileSaver
+    from ij import IJ, ImagePlus, WindowManager
+    from ij.gui import Roi, OvalRoi, Overlay, GenericDialog, ProfilePlot
+    from ij.process import Blitter, ByteProcessor, ImageProcessor, ImageStatistics, ShortProcessor
+    from ij.plugin import JpegWriter
+    from ij.measure import Measurements
+    from java.awt.event import KeyEvent, KeyAdapter, ActionListener, WindowAdapter
+    from javax.swing import JScrollPane, JPanel, JComboBox, JLabel, JFrame, JButton, JFormattedTextField, JTextField, JFileChooser, SwingUtilities
+    from java.awt import Color, GridLayout
+    from java.io import File
+    from java.lang import Runtime, System
+    from java.nio import ByteBuffer, ByteOrder
+    from org.python.core.util import StringUtil
+    import jarray
+    haveImageJ = True
+except ImportError:
+    # Outside of Fiji only the commands work, with the NumPy backend.
+    # The GUI classes still need something to inherit from.
+    haveImageJ = False
+    ActionListener = KeyAdapter = WindowAdapter = object
+try:
+    import mmap
+except ImportError:
+    # Jython doesn't have mmap, so files are read with seek and read
+    mmap = None
+try:
+    import resource
+except ImportError:
+    # Jython has no resource module, the JVM is asked instead
+    resource = None
+try:
+    import numpy
+    from PIL import Image as PILImage
+except ImportError:
+    numpy = None
+    PILImage = None
 
 
 ###########################################################################
-#####                       Begin Grid Reader                         #####
+#####                       Begin Timings                             #####
 ###########################################################################
 
 
-class GridReader:
+class Stopwatch:
+    """
+    Times a with block and records it under a stage of a Timings
     """
-    Displays cropped images of a plat based on a grid generated by the
-    Microarray Profile plugin:
 
-    http://www.optinav.com/MicroArray_Profile.htm
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.timings.record(self.stage, time.time() - self.start)
+        return False
+
+
+class NoStopwatch:
+    """
+    Stands in for a Stopwatch when timings are switched off
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+noStopwatch = NoStopwatch()
+
+
+class Timings:
+    """
+    Records how long each stage of a session takes, along with counts
+    such as bytes written and images read, and the peak memory used.
+    When it is switched off every method returns straight away, so it
+    can be left in the code that handles every well.
+
+    Stages are timed with a with block:
+
+        with timings.time("crop"):
+            ...
 
     Attributes:
-    - fp : string, a path to the grid to be read. If not specified,
-           imageJ will prompt you for a path. NOTE: the filename must be
-           in the form of "sourceImageName_gridName" and should be in the form
-           generated by the Microarray Profile plugin. No more underscores
-           are allowed in the name besides the one separating the names.
+    - enabled : bool, whether anything is recorded
     """
-    
-    def __init__(self, fp = None):
-        # Initialize the filepath to the grid file
-        if fp is None:
-            self.fp = IJ.getFilePath("Grid file")
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        # The seconds each stage took, indexed by the stage
+        self.stages = {}
+        # Indexed by the name of the count
+        self.counts = {}
+        self.peakMemory = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def time(self, stage):
+        if not self.enabled:
+            return noStopwatch
+        return Stopwatch(self, stage)
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = array("d")
+            self.stages[stage].append(seconds)
+
+    def count(self, name, amount = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def sampleMemory(self):
+        """
+        Notes the memory in use if it's the most seen so far
+        """
+        if not self.enabled:
+            return
+        if haveImageJ:
+            runtime = Runtime.getRuntime()
+            used = runtime.totalMemory() - runtime.freeMemory()
+        elif resource is not None:
+            # The most resident memory of the process, in kilobytes on Linux
+            used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
         else:
-            self.fp = fp
-        # Get the directory, the name of the grid, and the name of the image
-        self.initializeFilenames()
-        self.loadSourceImage()
-        self.initializeGridCoords()
-    
-    def initializeFilenames(self):
-        # Save the directory to the grid file
-        self.directory, gridfile = os.path.split( self.fp )
-        # Get the name of the grid file without the extension
-        # This is the "plateID" which is the concatenation of the image
-        # and the grid IDs
-        self.plateID, ext = os.path.splitext( gridfile )
-        # This expect that the grid file will be named according to
-        # imageID_plateID  This allows for multiple grids per plate
-        fnSplit = self.plateID.split("_")
-        if len(fnSplit) != 2:
-            raise ValueError("File name is not formatted properly")
-        # Save the imageID for later
-        self.imageID, tmp = fnSplit       
-    
-    def close(self):
+            return
+        with self.lock:
+            self.peakMemory = max(self.peakMemory, used)
+
+    def summary(self):
         """
-        This method is called by the Closing listener below
-        when the GUI frame is closed
+        Returns a dictionary with the count, total, p50, p95 and max
+        in milliseconds of each stage, the counts and the peak memory
         """
-        self.sourceImage.close()
-        
-    def initializeGridCoords(self):
+        def percentile(times, fraction):
+            return times[ min(len(times) - 1, int(fraction * len(times))) ]
+        with self.lock:
+            stages = {}
+            for stage, seconds in self.stages.items():
+                times = sorted(seconds)
+                stages[stage] = {
+                    "count" : len(times),
+                    "totalMs" : 1000 * sum(times),
+                    "p50Ms" : 1000 * percentile(times, 0.5),
+                    "p95Ms" : 1000 * percentile(times, 0.95),
+                    "maxMs" : 1000 * times[-1],
+                    }
+            return {
+                "seconds" : time.time() - self.started,
+                "stages" : stages,
+                "counts" : dict(self.counts),
+                "peakMemoryMB" : self.peakMemory / (1024.0 * 1024.0),
+                }
+
+    def write(self, fn):
         """
-        Initializes a list of coordinates that are used by
-        the open method. self.n indexes these coordinates
+        Writes the summary to a JSON file
         """
-        # Read the first line of the file
-        inGrid = open(self.fp,"r")
-        reader = csv.reader(inGrid , delimiter="\t" )
-        firstLine = reader.next()
-        try:
-            self.rows, self.columns, self.width = tuple(firstLine)
-            self.rows = int(self.rows)
-            self.columns = int(self.columns)
-            self.width = int(self.width)
-        except ValueError:
-            raise ValueError("There are the wrong number of fields on the first line")
-        self.gridCoords = []
-        row = 1
-        col = 1
-        for x,y in reader:
-            if col > self.columns:
-                col = 1
-                row = row + 1
-            self.gridCoords.append( (self.plateID, row, col, x, y) )
-            col = col + 1
-        inGrid.close()
-        
-    def loadSourceImage( self ):
+        out = open(fn, "w")
+        json.dump(self.summary(), out, indent=2, sort_keys=True)
+        out.write("\n")
+        out.close()
+
+
+
+###########################################################################
+#####                       Begin Score Journal                       #####
+###########################################################################
+
+
+class ScoreJournal:
+    """
+    An append-only log of scores that lives next to the score file.
+
+    Each score is appended as one line in the same format as the score
+    file, so saving a score costs the same whether one or a thousand
+    wells have been scored. A well that is scored again gets a new line
+    and the last line for a well wins when the journal is replayed.
+    compact() folds the journal back into the score file and removes it.
+
+    Attributes:
+    - scoreFile : string, the csv file the journal is compacted into
+    - syncEvery : integer, fsync the journal after this many scores.
+      1 syncs every score, 0 leaves it to the operating system.
+    """
+    header = ["plate", "row", "col", "x", "y", "min", "max", "score"]
+
+    def __init__(self, scoreFile, syncEvery = 1):
+        self.scoreFile = scoreFile
+        self.journalFile = scoreFile + ".journal"
+        self.syncEvery = syncEvery
+        self.out = None
+        self.unsynced = 0
+
+    def exists(self):
+        return os.path.isfile(self.scoreFile) or os.path.isfile(self.journalFile)
+
+    def lastWritten(self):
         """
-        Loads the image that the grid was set up on
+        Returns when a score was last written, as a time.time(), or
+        None if there are no scores
         """
-        imgPath = os.path.join(self.directory, self.imageID + ".tif")
-        img = ImagePlus(imgPath)
-        if img is None:
-            raise ValueError("Couldn't find the image")
-        self.sourceImage = img
-    
-    def openSubImage( self, x, y, auto=False ):
+        times = [os.path.getmtime(fn) for fn in [self.scoreFile, self.journalFile]
+                 if os.path.isfile(fn)]
+        if not times:
+            return None
+        return max(times)
+
+    def replay(self):
         """
-        This method is called by both openPrevious and openNext to
-        display an image that is cropped from the sourceImage based
-        on the grid coordinates
+        Returns the rows of the score file followed by the rows of
+        the journal, in the order they were written. Rows that don't
+        have a field for every column (e.g. a line cut short by a
+        crash) are skipped.
+        """
+        rows = []
+        for fn in [self.scoreFile, self.journalFile]:
+            if not os.path.isfile(fn):
+                continue
+            inFile = open(fn, "r")
+            for row in csv.reader(inFile, delimiter=","):
+                if len(row) == len(self.header) and row != self.header:
+                    rows.append(row)
+            inFile.close()
+        return rows
+
+    def record(self, info):
+        """
+        Appends a single score to the journal
 
         Arguments:
-        - auto : bool, if True the image is autoscaled
+        - info : tuple, (plate, row, col, x, y, min, max, score)
         """
-        # Set the ROI on the source image
-        #roi = Roi(int(self.x), int(self.y), int(self.width), int(self.width))
-        roi = Roi( int(x), int(y), int(self.width), int(self.width) )
-        self.sourceImage.setRoi(roi)
-        # Get a processor corresponding to a cropped version of the image
-        processor = self.sourceImage.getProcessor().crop()
-        self.sourceImage.killRoi()
-        # Make a new image of image and run contrast on it
-        openImage = ImagePlus(" ", processor)
-        return openImage
+        if self.out is None:
+            self.out = open(self.journalFile, "a")
+        writer = csv.writer(self.out, delimiter=",")
+        writer.writerow(info)
+        self.out.flush()
+        self.unsynced = self.unsynced + 1
+        if self.syncEvery > 0 and self.unsynced >= self.syncEvery:
+            os.fsync(self.out.fileno())
+            self.unsynced = 0
 
-    def getCoords(self):
-        return self.gridCoords
+    def compact(self, scores):
+        """
+        Writes every score to the score file and removes the journal.
+        The score file is written to a temporary file first so that a
+        crash can't leave a truncated score file behind.
 
-    def getPlateID(self):
-        return self.plateID
-    
+        Arguments:
+        - scores : list, the (plate, row, col, x, y, min, max, score)
+          tuples to keep, in the order they should be written
+        """
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        tmpFile = self.scoreFile + ".tmp"
+        out = open(tmpFile, "w")
+        writer = csv.writer(out, delimiter=",")
+        writer.writerow(self.header)
+        for info in scores:
+            writer.writerow(info)
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        try:
+            os.rename(tmpFile, self.scoreFile)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(self.scoreFile)
+            os.rename(tmpFile, self.scoreFile)
+        if os.path.isfile(self.journalFile):
+            os.remove(self.journalFile)
 
-            
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
 
-class GridSet:
-    """
-    A class to keep track of multiple grid readers.
-    
-    cContains methods to keep track of scores and move forward and
-    backward while keeping track of the scores.
 
-    Writes a csv file containing the information about the grid as well
-    as the score that was assigned to each cell in the grid.
 
-    Writes a jpg thumbnail for each cropped cell in the grid.
+###########################################################################
+#####                       Begin Score Database                      #####
+###########################################################################
 
-    Writes an HTML report that matches scores to images.
 
-    Images are displayed randomly to prevent biased scoring.
+def connectDatabase(dbFile):
+    """
+    Opens a SQLite database with the sqlite3 module or, in Jython
+    which doesn't have it, with zxJDBC and the SQLite JDBC driver
+    that comes with Fiji
+    """
+    try:
+        import sqlite3
+    except ImportError:
+        from com.ziclix.python.sql import zxJDBC
+        return zxJDBC.connect("jdbc:sqlite:" + dbFile, "", "", "org.sqlite.JDBC")
+    return sqlite3.connect(dbFile, timeout=30, check_same_thread=False)
 
-    Arguments:
 
-    - fp : list, paths the the grid files used by the GridReader
-    - scoreFile : string, an string giving the filename of the
-      scores to write to.
-    - thumbDir : string, the name of the directory to save the
-      thumbnails in
+class ScoreDatabase:
     """
-    def __init__(self, fp, scoreFile, thumbDir):
-        # These will be indexed by the grid coordinates
-        self.scores = {}
-        # These will be indexed by the plateID
-        self.grids = {}
-        # Keeps the grid coordinates from each grid
-        self.gridCoords = []
-        for i in fp:
-            grid = GridReader(i)
-            # each coordinate is a tuple: (plateID, row, col, x, y)
-            gridCoords = grid.getCoords()
-            # save the grid reader in a dictionary
-            self.grids[ grid.getPlateID() ] = grid
-            # append the coordinates to the coordinates pile
-            for coord in gridCoords:
-                self.gridCoords.append(coord)
-        # shuffle the coordinates
-        shuffle(self.gridCoords)
-        # Initialize the images, and some variable names
-        self.openImage = ImagePlus()
-        self.thumbDir = thumbDir
-        self.scoreFile = scoreFile
-        self.reportFile = os.path.splitext(scoreFile)[0] + ".html"
-        self.reportFile2 = os.path.splitext(scoreFile)[0] + "-with-plate-positions.html"
-        self.min = 0
-        self.max = 255
-        # This is the current coordinate position
-        self.n = -1
-        # Test for scorefiles
-        if os.path.isfile( self.scoreFile ):
-            print "Restoring previous scores"
-            self.restoreScores()
-        # Generate a spot for the HTML report to live in along with the thumbnails
-        try:
-            os.mkdir(self.thumbDir)
-        except OSError:
-            pass
+    Keeps the scores of several scorers in one SQLite database, so
+    that people (or headless workers) can score the same plates at
+    the same time without overwriting each other's score files.
 
-    def restoreScores(self):
-        """
-        If a file with the same name is detected as the output score file,
-        this method is called. It reads in the previous scores and
-        sets the first image to be the image after the previous scores
-        """
-        # Open a file to the scores
-        inFile = open( self.scoreFile , "r" )
-        reader = csv.reader(inFile, delimiter=",")
-        header = reader.next()
-        # This will store the coordinates corresponding to the previous scores
-        tmpCoords = []
-        # for each row in the scores file, append the previous coordinates
-        # and make an entry for the score
-        for row in reader:
-            plateID, row, col, x, y, theMin, theMax, score = row
-            coord = (plateID, row, col, x, y)
-            self.scores[ coord ] = (plateID, row, col, x, y, theMin, theMax, score)
-            tmpCoords.append(coord)
-        self.min = int(theMin)
-        self.max = int(theMax)
-        self.n = len(tmpCoords) - 1
-        if self.n < 0:
-            self.n = 0
-        for coord in self.gridCoords:
-            if coord not in self.scores:
-                tmpCoords.append(coord)
-        self.gridCoords = tmpCoords
-        
-    def writeThumbnail(self):
-        plateID, row, col, x, y = self.currentCoordinate
-        imName = "_".join([ str(plateID), str(row), str(col) ] ) + ".jpg"
-        imName = os.path.join(self.thumbDir, imName)
-        fs = FileSaver(self.openImage)
-        fs.saveAsJpeg( imName )
+    The database is opened in WAL mode, so one scorer writing doesn't
+    block the others from reading, and writers wait their turn. It has
+    a table of the wells, a table with the last score each scorer gave
+    each well, and a table with the order each scorer sees the wells in.
 
-    def setMinAndMax(self, minVal = None, maxVal = None):
+    It is used by GridSet in place of a ScoreJournal and works the same
+    way, except that replay() only returns the scores of this scorer
+    and compact() writes them to the score file without removing
+    anything from the database.
+
+    Attributes:
+    - dbFile : string, the path to the database. It is created if it
+      doesn't exist.
+    - scoreFile : string, the csv file the scores of this scorer are
+      written to by compact()
+    - scorer : string, the name the scores are saved under
+    - syncEvery : integer, commit after this many scores
+    """
+    header = ScoreJournal.header
+
+    def __init__(self, dbFile, scoreFile, scorer, syncEvery = 1):
+        self.dbFile = dbFile
+        self.scoreFile = scoreFile
+        self.scorer = scorer
+        self.syncEvery = max(1, syncEvery)
+        self.uncommitted = 0
+        self.db = connectDatabase(dbFile)
+        cursor = self.db.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS wells (
+            plate TEXT, row INTEGER, col INTEGER, x TEXT, y TEXT,
+            PRIMARY KEY (plate, row, col))""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS scores (
+            plate TEXT, row INTEGER, col INTEGER, scorer TEXT,
+            min INTEGER, max INTEGER, score TEXT, time REAL,
+            PRIMARY KEY (plate, row, col, scorer))""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS scoresByScorer ON scores (scorer, time)")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS sessionOrder (
+            scorer TEXT, position INTEGER, plate TEXT, row INTEGER, col INTEGER,
+            PRIMARY KEY (scorer, position))""")
+        cursor.close()
+        self.db.commit()
+
+    def addWells(self, coords):
         """
-        Sets the min and max of the current image
+        Adds wells to the wells table
 
         Arguments:
-        - minVal : integer, the minimum value for the pixel display
-        - maxVal : integer, the maximum value for the pixel display
+        - coords : list, (plate, row, col, x, y) tuples
         """
-        if minVal is not None:
-            self.min = minVal
-        if maxVal is not None:
-            self.max = maxVal
-        self.openImage.getProcessor().setMinAndMax(self.min, self.max)
-        self.openImage.updateChannelAndDraw()
-        self.writeThumbnail()
-            
-    def openNext(self):
+        cursor = self.db.cursor()
+        cursor.executemany("INSERT OR REPLACE INTO wells VALUES (?, ?, ?, ?, ?)",
+                           [tuple(coord) for coord in coords])
+        cursor.close()
+        self.db.commit()
+
+    def saveOrder(self, coords):
         """
-        Opens the next image.
+        Saves the order this scorer sees the wells in
 
         Arguments:
-        - thumbNails : bool, if True a thumbnail for th
-          image is written when the image is opened
+        - coords : list, (plate, row, col, ...) tuples in order
         """
-        self.openImage.close()
-        # Set the current number being examined
-        self.n = self.n + 1
-        try:
-            self.currentCoordinate = self.gridCoords[ self.n ]
-        except IndexError:
-            gd = GenericDialog("")
-            gd.addMessage("No more images")
-            gd.showDialog()
-            return None
-        plateID, row, col, x, y = self.currentCoordinate
-        # open the file
-        grid = self.grids[ plateID ]
-        self.openImage = grid.openSubImage(x,y)
-        self.setMinAndMax()
-        self.openImage.show()
-        # Write the thumbnail
-        self.writeThumbnail()
-        # Try to return the information about the current score
-        # if it doesn't exist, return an empty string. This
-        # is used to display the score associated with the image
-        try:
-            return self.scores[ self.currentCoordinate ][7]
-        except KeyError:
-            return ""
+        cursor = self.db.cursor()
+        cursor.execute("DELETE FROM sessionOrder WHERE scorer = ?", (self.scorer,))
+        cursor.executemany("INSERT INTO sessionOrder VALUES (?, ?, ?, ?, ?)",
+                           [(self.scorer, i, coord[0], coord[1], coord[2])
+                            for i, coord in enumerate(coords)])
+        cursor.close()
+        self.db.commit()
 
-    def openPrevious(self):
+    def exists(self):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM scores WHERE scorer = ?", (self.scorer,))
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count > 0
+
+    def lastWritten(self):
         """
-        Opens the previous image.
+        Returns when this scorer last gave a score, as a time.time(),
+        or None if they haven't
         """
-        self.n = self.n - 1
+        cursor = self.db.cursor()
+        cursor.execute("SELECT MAX(time) FROM scores WHERE scorer = ?", (self.scorer,))
+        last = cursor.fetchone()[0]
+        cursor.close()
+        return last
+
+    def replay(self):
+        """
+        Returns the scores of this scorer as rows of the score file,
+        in the order they were given
+        """
+        return scoreRows(self.db, self.scorer)
+
+    def record(self, info):
+        """
+        Saves a single score, replacing the score this scorer
+        gave the well before
+
+        Arguments:
+        - info : tuple, (plate, row, col, x, y, min, max, score)
+        """
+        plateID, row, col, x, y, theMin, theMax, score = info
+        cursor = self.db.cursor()
+        cursor.execute("INSERT OR IGNORE INTO wells VALUES (?, ?, ?, ?, ?)",
+                       (plateID, int(row), int(col), str(x), str(y)))
+        cursor.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (plateID, int(row), int(col), self.scorer,
+                        int(theMin), int(theMax), score, time.time()))
+        cursor.close()
+        self.uncommitted = self.uncommitted + 1
+        if self.uncommitted >= self.syncEvery:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def compact(self, scores):
+        """
+        Writes the scores of this scorer to the score file. Raises
+        ValueError, and leaves the score file alone, if it or its
+        journal has wells that aren't in scores, since then it isn't
+        this scorer's file.
+
+        Arguments:
+        - scores : list, the (plate, row, col, x, y, min, max, score)
+          tuples to write, in the order they should be written
+        """
+        self.db.commit()
+        self.uncommitted = 0
+        journal = ScoreJournal(self.scoreFile)
+        kept = {}
+        for info in scores:
+            kept[ (str(info[0]), str(info[1]), str(info[2])) ] = True
+        lost = [row for row in journal.replay() if (row[0], row[1], row[2]) not in kept]
+        if lost:
+            raise ValueError("%s has %i wells that %s hasn't scored in %s, so it wasn't "
+                             "written over. The scores are in the database."
+                             % (self.scoreFile, len(lost), self.scorer, self.dbFile))
+        journal.compact(scores)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def scoreRows(db, scorer = None):
+    """
+    Returns scores from a score database as rows of a score file, in
+    the order they were given. If scorer isn't specified the scores of
+    every scorer are returned, with the scorer added to each row.
+    """
+    query = """SELECT scores.plate, scores.row, scores.col, wells.x, wells.y,
+                      scores.min, scores.max, scores.score, scores.scorer
+               FROM scores LEFT JOIN wells
+               ON scores.plate = wells.plate AND scores.row = wells.row AND scores.col = wells.col"""
+    cursor = db.cursor()
+    if scorer is None:
+        cursor.execute(query + " ORDER BY scores.time")
+    else:
+        cursor.execute(query + " WHERE scores.scorer = ? ORDER BY scores.time", (scorer,))
+    rows = []
+    for row in cursor.fetchall():
+        row = ["" if value is None else str(value) for value in row]
+        if scorer is None:
+            rows.append(row)
+        else:
+            rows.append(row[:-1])
+    cursor.close()
+    return rows
+
+
+def dbExportCommand(argv):
+    parser = argparse.ArgumentParser(
+        prog="dbexport",
+        description="Write the scores in a score database to a score file")
+    parser.add_argument("database", help="score database")
+    parser.add_argument("scoreFile", help="CSV file to write the scores to")
+    parser.add_argument("--scorer", default=None,
+                        help="only write the scores of this scorer. Otherwise every "
+                             "score is written with a scorer column.")
+    args = parser.parse_args(argv)
+    db = connectDatabase(args.database)
+    rows = scoreRows(db, args.scorer)
+    db.close()
+    out = open(args.scoreFile, "w")
+    writer = csv.writer(out, delimiter=",")
+    if args.scorer is None:
+        writer.writerow(ScoreJournal.header + ["scorer"])
+    else:
+        writer.writerow(ScoreJournal.header)
+    for row in rows:
+        writer.writerow(row)
+    out.close()
+    print("Wrote %i scores" % len(rows))
+
+
+
+###########################################################################
+#####                       Begin Prefetcher                          #####
+###########################################################################
+
+
+class Prefetcher:
+    """
+    Crops the next few cells on a background thread while the current
+    cell is being scored, and keeps the last few cells around so that
+    going back doesn't crop them again.
+
+    Cells are referred to by their position in the display order.
+
+    Attributes:
+    - crop : function, takes a position and returns an ImageProcessor
+      with the cell at that position
+    - ahead : integer, the number of cells to crop ahead of the
+      current one. 0 turns off the background thread.
+    - behind : integer, the number of cells to keep behind the
+      current one
+    - count : integer, the number of positions. Nothing past the last
+      one is cropped. None if there's no end.
+    """
+
+    def __init__(self, crop, ahead = 3, behind = 2, count = None):
+        self.crop = crop
+        self.ahead = ahead
+        self.behind = behind
+        self.count = count
+        # These are indexed by position
+        self.ready = {}
+        # Positions waiting to be cropped, most urgent first
+        self.wanted = []
+        self.n = -1
+        self.closed = False
+        self.condition = threading.Condition()
+        self.worker = None
+        if self.ahead > 0:
+            self.worker = threading.Thread(target=self.run, name="ccm-prefetch")
+            self.worker.setDaemon(True)
+            self.worker.start()
+
+    def inWindow(self, n):
+        return self.n - self.behind <= n <= self.n + self.ahead
+
+    def moveTo(self, n):
+        """
+        Makes n the current position, forgets the cells that are
+        too far away and queues the cells ahead of n
+        """
+        with self.condition:
+            self.n = n
+            for i in [i for i in self.ready.keys() if not self.inWindow(i)]:
+                del self.ready[i]
+            last = n + self.ahead
+            if self.count is not None:
+                last = min(last, self.count - 1)
+            self.wanted = [i for i in range(n + 1, last + 1)
+                           if i not in self.ready]
+            self.condition.notify()
+
+    def take(self, n):
+        """
+        Returns the processor for position n, or None if it
+        hasn't been cropped
+        """
+        with self.condition:
+            return self.ready.get(n)
+
+    def put(self, n, processor):
+        with self.condition:
+            self.ready[n] = processor
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                n = self.wanted.pop(0)
+            try:
+                processor = self.crop(n)
+            except:
+                # The cell is cropped again when it's shown, which
+                # raises the error where it can be seen
+                print("Couldn't prefetch cell %i: %s" % (n, sys.exc_info()[1]))
+                continue
+            with self.condition:
+                if self.inWindow(n):
+                    self.ready[n] = processor
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.ready = {}
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.join()
+
+
+###########################################################################
+#####                       Begin Plate Loader                        #####
+###########################################################################
+
+
+class PlateLoader:
+    """
+    Gets plates ready on a pool of background threads, so the first
+    cell can be shown as soon as its own plate is ready while the
+    rest keep loading.
+
+    Attributes:
+    - load : function, takes a plateID and gets the plate ready
+    - plateIDs : list, the plates in the order they should be loaded
+    - workers : integer, the number of threads
+    - progress : function, called with the number of plates that are
+      ready and the number of plates after each plate. It is called
+      from the loading threads.
+    """
+
+    def __init__(self, load, plateIDs, workers, progress = None):
+        self.load = load
+        self.queue = [i for i in plateIDs]
+        self.total = len(self.queue)
+        self.done = 0
+        self.progress = progress
+        self.closed = False
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(max(1, min(workers, self.total))):
+            thread = threading.Thread(target=self.run, name="ccm-loader-%i" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.closed or not self.queue:
+                    return
+                plateID = self.queue.pop(0)
+            try:
+                self.load(plateID)
+            except:
+                # The plate is loaded when it's needed instead
+                print("Couldn't load %s" % plateID)
+            with self.lock:
+                self.done = self.done + 1
+                done = self.done
+            if self.progress is not None:
+                self.progress(done, self.total)
+
+    def close(self):
+        """
+        Stops loading plates and waits for the
+        ones that are being loaded
+        """
+        with self.lock:
+            self.closed = True
+        for thread in self.threads:
+            thread.join()
+
+
+###########################################################################
+#####                       Begin Thumbnail Writer                    #####
+###########################################################################
+
+
+class ThumbnailFormat:
+    """
+    How thumbnails are written. The min and max are applied first, and
+    the thumbnail is then shrunk to fit in size x size pixels, since
+    the reports never show it any bigger. Small cells aren't enlarged.
+
+    Attributes:
+    - size : integer, the most width and height of a thumbnail, or 0
+      to keep the size of the cell. The reports show thumbnails at
+      this size, 300 pixels by default.
+    - format : string, "jpeg" or "png". PNGs are lossless, for
+      keeping the thumbnails.
+    - quality : integer, the JPEG quality from 0 to 100
+    - full : bool, if True the cell is also written at full size to
+      the "full" folder next to the thumbnail, and the reports link
+      the thumbnails to it
+    """
+
+    def __init__(self, size = 300, format = "jpeg", quality = 85, full = False):
+        if format not in ("jpeg", "png"):
+            raise ValueError("Unknown thumbnail format: %s" % format)
+        self.size = size
+        self.format = format
+        self.quality = quality
+        self.full = full
+        if format == "png":
+            self.extension = ".png"
+        else:
+            self.extension = ".jpg"
+
+    def name(self, plateID, row, col):
+        """
+        Returns the file name of the thumbnail of a cell
+        """
+        return thumbnailName(plateID, row, col, self.extension)
+
+    def fullName(self, fn):
+        """
+        Returns the name of the full size copy of the thumbnail fn
+        """
+        return os.path.join(os.path.dirname(fn), "full", os.path.basename(fn))
+
+    def shrink(self, processor):
+        """
+        Returns an 8-bit copy of processor as it's displayed, shrunk to
+        fit the thumbnail size
+        """
+        shown = imaging.displayCopy(processor)
+        w, h = shown.getWidth(), shown.getHeight()
+        if not self.size or max(w, h) <= self.size:
+            return shown
+        scale = self.size / float(max(w, h))
+        return imaging.resize(shown, max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+
+    def save(self, processor, fn):
+        imaging.save(processor, fn, self.format, self.quality)
+
+    def write(self, processor, fn):
+        """
+        Writes the thumbnail of processor to fn, and the full size cell
+        if it's kept
+        """
+        self.save(self.shrink(processor), fn)
+        if self.full:
+            self.writeFull(processor, fn)
+
+    def writeFull(self, processor, fn):
+        fullName = self.fullName(fn)
+        try:
+            os.mkdir(os.path.dirname(fullName))
+        except OSError:
+            pass
+        self.save(imaging.displayCopy(processor), fullName)
+
+
+class ThumbnailWriter:
+    """
+    Writes thumbnails on a background thread so that the GUI
+    doesn't wait for them to be encoded.
+
+    If a thumbnail is asked for again before it has been written (e.g.
+    the min and max are changed a few times in a row), only the latest
+    image is written.
+
+    Attributes:
+    - maxPending : integer, the number of thumbnails that can wait to
+      be written. write() waits for room when there are this many.
+    - timings : Timings, records how long each thumbnail takes to
+      write and the bytes written
+    - thumbnailFormat : ThumbnailFormat, the size and format of the
+      thumbnails. Defaults to ThumbnailFormat().
+    """
+
+    def __init__(self, maxPending = 16, timings = None, thumbnailFormat = None):
+        self.maxPending = maxPending
+        if timings is None:
+            timings = Timings()
+        self.timings = timings
+        if thumbnailFormat is None:
+            thumbnailFormat = ThumbnailFormat()
+        self.thumbnailFormat = thumbnailFormat
+        # These are indexed by the thumbnail file name
+        self.pending = {}
+        # Thumbnail file names in the order they were asked for
+        self.queue = []
+        self.busy = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self.run, name="ccm-thumbnails")
+        self.worker.setDaemon(True)
+        self.worker.start()
+
+    def write(self, processor, imName):
+        """
+        Queues processor to be written to imName. The processor
+        shouldn't be changed afterwards, so pass in a copy of the
+        displayed one.
+        """
+        with self.condition:
+            if imName in self.pending:
+                self.pending[imName] = processor
+                return
+            while len(self.queue) >= self.maxPending:
+                self.condition.wait()
+            self.pending[imName] = processor
+            self.queue.append(imName)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                imName = self.queue.pop(0)
+                processor = self.pending.pop(imName)
+                self.busy = True
+                self.condition.notify_all()
+            try:
+                with self.timings.time("thumbnail"):
+                    self.thumbnailFormat.write(processor, imName)
+                if self.timings.enabled:
+                    self.timings.count("thumbnailBytes", os.path.getsize(imName))
+            except:
+                # Keep going so the rest of the thumbnails are written
+                print("Couldn't write %s" % imName)
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def flush(self):
+        """
+        Waits until every queued thumbnail has been written
+        """
+        with self.condition:
+            while self.queue or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.worker.join()
+
+
+###########################################################################
+#####                       Begin Sprite Sheets                       #####
+###########################################################################
+
+# Instead of a JPEG for each well, thumbnails can be packed into a few
+# large JPEGs (sprite sheets). An index says where each well is on its
+# sheet, and reports show the wells as regions of the sheets with CSS.
+
+
+def safeName(text):
+    """
+    Returns text with only the characters that are safe in a file name
+    """
+    return "".join([c if c.isalnum() or c in "-." else "_" for c in text]) or "none"
+
+
+def displayTable(theMin, theMax):
+    """
+    Returns the table that maps 8-bit pixels to what's displayed with
+    min and max, the way ImageJ scales them
+    """
+    scale = 256.0 / (theMax - theMin + 1)
+    return [max(0, min(255, int((i - theMin) * scale))) for i in range(256)]
+
+
+class SpriteSheet:
+    """
+    An image of many thumbnails, laid out in rows of columns cells of
+    cellSize pixels in the order of keys. Cells smaller than cellSize
+    (wells clipped by the edge of the image) sit in the top left of
+    their space. The sheet is only made when the first cell is pasted
+    and is freed when it's saved.
+
+    Attributes:
+    - fn : string, the image to write
+    - keys : list, the (plate, row, col) of each cell
+    - cellSize : integer, the width and height of each cell's space
+    - columns : integer, the most cells in a row
+    - thumbnailFormat : ThumbnailFormat, how the sheet is written.
+      Cells should be shrunk with it before they're pasted.
+    - cells : dict, the (x, y, width, height) of each key that has
+      been pasted
+    """
+
+    def __init__(self, fn, keys, cellSize, columns, thumbnailFormat = None):
+        if thumbnailFormat is None:
+            thumbnailFormat = ThumbnailFormat()
+        self.thumbnailFormat = thumbnailFormat
+        self.fn = fn
+        self.keys = keys
+        self.cellSize = cellSize
+        self.columns = min(columns, len(keys))
+        self.rows = (len(keys) + self.columns - 1) // self.columns
+        self.width = self.columns * cellSize
+        self.height = self.rows * cellSize
+        self.slots = dict([(key, i) for i, key in enumerate(keys)])
+        self.cells = {}
+        self.processor = None
+
+    def paste(self, key, processor):
+        """
+        Pastes processor, an 8-bit copy of a cell as it's displayed
+        (see ThumbnailFormat.shrink), into the cell of key. Returns
+        True when every cell has been pasted.
+        """
+        if self.processor is None:
+            self.processor = imaging.newSheet(self.width, self.height)
+        slot = self.slots[key]
+        x = (slot % self.columns) * self.cellSize
+        y = (slot // self.columns) * self.cellSize
+        w = min(processor.getWidth(), self.cellSize)
+        h = min(processor.getHeight(), self.cellSize)
+        imaging.paste(self.processor, processor, x, y)
+        self.cells[key] = (x, y, w, h)
+        return len(self.cells) == len(self.keys)
+
+    def save(self):
+        if self.processor is not None:
+            self.thumbnailFormat.save(self.processor, self.fn)
+            self.processor = None
+
+
+def planSpriteSheets(directory, groups, cellSize, cellsPerSheet = 100, columns = 10,
+                     thumbnailFormat = None):
+    """
+    Returns the SpriteSheets for groups of wells. Each group gets its
+    own sheets, named sprites-<group>-<n>.jpg (or .png).
+
+    Arguments:
+    - directory : string, where the sheets are written
+    - groups : list, (name, keys) pairs, where keys are the
+      (plate, row, col) of the wells in the order they go on the sheets
+    - cellSize : integer, see SpriteSheet
+    - cellsPerSheet : integer, the most wells on a sheet
+    - columns : integer, the most wells in a row of a sheet
+    - thumbnailFormat : ThumbnailFormat, how the sheets are written
+    """
+    if thumbnailFormat is None:
+        thumbnailFormat = ThumbnailFormat()
+    if thumbnailFormat.size:
+        cellSize = min(cellSize, thumbnailFormat.size)
+    sheets = []
+    for name, keys in groups:
+        for start in range(0, len(keys), cellsPerSheet):
+            fn = os.path.join(directory, "sprites-%s-%i%s" % (
+                safeName(name), start // cellsPerSheet + 1, thumbnailFormat.extension))
+            sheets.append( SpriteSheet(fn, keys[start:start + cellsPerSheet], cellSize, columns,
+                                       thumbnailFormat) )
+    return sheets
+
+
+def writeSpriteIndex(fn, sheets):
+    """
+    Writes where each well is: the sheet, plate, row, col and the x,
+    y, width and height of the well on the sheet, tab separated
+    """
+    out = open(fn, "w")
+    writer = csv.writer(out, delimiter="\t")
+    for sheet in sheets:
+        for key in sheet.keys:
+            if key in sheet.cells:
+                writer.writerow([os.path.basename(sheet.fn)] + [i for i in key] +
+                                [i for i in sheet.cells[key]])
+    out.close()
+
+
+def spriteIndex(sheets):
+    """
+    Returns (sheet file, x, y, width, height, sheet width, sheet height)
+    of each pasted well, indexed by (plate, row, col)
+    """
+    index = {}
+    for sheet in sheets:
+        for key, (x, y, w, h) in sheet.cells.items():
+            index[key] = (sheet.fn, x, y, w, h, sheet.width, sheet.height)
+    return index
+
+
+###########################################################################
+#####                       Begin TIFF Reader                         #####
+###########################################################################
+
+
+class TiffWindowReader:
+    """
+    Reads rectangles out of a TIFF file without reading the whole
+    image, so cells can be cropped from scans that are too big to
+    keep in memory and the first crop from a new image is fast.
+
+    Only the strips or tiles that overlap a rectangle are read. The
+    rows of uncompressed strips are read directly from the file, which
+    is memory-mapped where the mmap module is available. Compressed
+    strips and tiles (PackBits or Deflate) are decompressed whole and
+    the last few are kept in a small cache.
+
+    Single channel 8 and 16 bit images are supported. For anything
+    else (e.g. LZW, RGB or float images) supported is False and the
+    whole image should be read by ImageJ instead. Only the first image
+    in the file is read.
+
+    Attributes:
+    - path : string, the path to the TIFF
+    - stripCacheSize : integer, the number of decompressed strips or
+      tiles to keep
+    - imageBytes : integer, the memory the pixels of the image take
+      once it's decoded, or None if the header couldn't be read. It's
+      set for images that aren't supported too.
+    """
+
+    def __init__(self, path, stripCacheSize = 8):
+        self.path = path
+        self.stripCacheSize = stripCacheSize
+        self.supported = False
+        # Decompressed strips indexed by their number, and
+        # their numbers with the least recently used first
+        self.strips = {}
+        self.stripOrder = []
+        self.lock = threading.Lock()
+        # Held while seeking and reading the file
+        self.ioLock = threading.Lock()
+        self.mapped = None
+        self.imageBytes = None
+        self.inFile = open(path, "rb")
+        try:
+            self.readHeader()
+        except (ValueError, KeyError, IndexError, struct.error):
+            self.supported = False
+        if self.supported and self.compression == 1 and mmap is not None:
+            try:
+                self.mapped = mmap.mmap(self.inFile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                self.mapped = None
+
+    def read(self, offset, length):
+        if self.mapped is not None:
+            return self.mapped[offset:offset + length]
+        with self.ioLock:
+            self.inFile.seek(offset)
+            return self.inFile.read(length)
+
+    def readHeader(self):
+        """
+        Reads the tags of the first image in the file
+        """
+        order = self.read(0, 2)
+        if order == b"II":
+            self.endian = "<"
+        elif order == b"MM":
+            self.endian = ">"
+        else:
+            raise ValueError("Not a TIFF file")
+        self.littleEndian = self.endian == "<"
+        magic, ifdOffset = struct.unpack(self.endian + "HI", self.read(2, 6))
+        if magic != 42:
+            # BigTIFF isn't supported
+            raise ValueError("Not a TIFF file")
+        nTags = struct.unpack(self.endian + "H", self.read(ifdOffset, 2))[0]
+        entries = self.read(ifdOffset + 2, nTags * 12)
+        # Sizes of the TIFF field types (BYTE, ASCII, SHORT, LONG, ...)
+        typeSizes = {1: ("B", 1), 2: ("B", 1), 3: ("H", 2), 4: ("I", 4),
+                     6: ("b", 1), 8: ("h", 2), 9: ("i", 4), 16: ("Q", 8)}
+        tags = {}
+        for i in range(nTags):
+            tag, fieldType, count = struct.unpack(self.endian + "HHI", entries[i * 12:i * 12 + 8])
+            if fieldType not in typeSizes:
+                continue
+            code, size = typeSizes[fieldType]
+            data = entries[i * 12 + 8:i * 12 + 12]
+            if size * count > 4:
+                offset = struct.unpack(self.endian + "I", data)[0]
+                data = self.read(offset, size * count)
+            tags[tag] = struct.unpack(self.endian + code * count, data[:size * count])
+        self.width = tags[256][0]
+        self.height = tags[257][0]
+        self.bitsPerSample = tags.get(258, (1,))[0]
+        self.compression = tags.get(259, (1,))[0]
+        photometric = tags.get(262, (1,))[0]
+        samplesPerPixel = tags.get(277, (1,))[0]
+        predictor = tags.get(317, (1,))[0]
+        sampleFormat = tags.get(339, (1,))[0]
+        self.imageBytes = (self.width * self.height * samplesPerPixel *
+                           ((self.bitsPerSample + 7) // 8))
+        if 322 in tags:
+            self.tileWidth = tags[322][0]
+            self.tileHeight = tags[323][0]
+            self.offsets = tags[324]
+            self.byteCounts = tags[325]
+        else:
+            # Strips are tiles that are as wide as the image
+            self.tileWidth = self.width
+            self.tileHeight = tags.get(278, (self.height,))[0]
+            self.offsets = tags[273]
+            self.byteCounts = tags.get(279, ())
+        self.tileHeight = min(self.tileHeight, self.height)
+        self.tilesAcross = (self.width + self.tileWidth - 1) // self.tileWidth
+        self.bytesPerPixel = self.bitsPerSample // 8
+        self.supported = (self.bitsPerSample in (8, 16) and samplesPerPixel == 1
+                          and photometric == 1 and sampleFormat == 1
+                          and predictor == 1 and self.compression in (1, 8, 32773, 32946))
+
+    def tile(self, n):
+        """
+        Returns tile (or strip) n decompressed
+        """
+        with self.lock:
+            if n in self.strips:
+                self.stripOrder.remove(n)
+                self.stripOrder.append(n)
+                return self.strips[n]
+        data = self.read(self.offsets[n], self.byteCounts[n])
+        if self.compression in (8, 32946):
+            data = zlib.decompress(data)
+        elif self.compression == 32773:
+            data = unpackBits(data)
+        with self.lock:
+            self.strips[n] = data
+            self.stripOrder.append(n)
+            while len(self.stripOrder) > self.stripCacheSize:
+                del self.strips[ self.stripOrder.pop(0) ]
+        return data
+
+    def readWindow(self, x, y, w, h):
+        """
+        Returns the pixels of a rectangle of the image. Like an ImageJ
+        crop, the rectangle is clipped to the image first.
+
+        Returns (pixels, x, y, w, h) where pixels is a string of w*h
+        pixels in the byte order of the file, row by row, and x, y, w
+        and h are the clipped rectangle.
+        """
+        x, y, w, h = clipRect(x, y, w, h, self.width, self.height)
+        bpp = self.bytesPerPixel
+        rowBytes = w * bpp
+        pixels = bytearray(rowBytes * h)
+        for row in range(y, y + h):
+            tileRow = row // self.tileHeight
+            rowInTile = row - tileRow * self.tileHeight
+            col = x
+            while col < x + w:
+                tileCol = col // self.tileWidth
+                n = tileRow * self.tilesAcross + tileCol
+                tileX = tileCol * self.tileWidth
+                end = min(x + w, tileX + self.tileWidth)
+                start = ((rowInTile * self.tileWidth) + (col - tileX)) * bpp
+                length = (end - col) * bpp
+                if self.compression == 1:
+                    data = self.read(self.offsets[n] + start, length)
+                else:
+                    data = self.tile(n)[start:start + length]
+                out = (row - y) * rowBytes + (col - x) * bpp
+                pixels[out:out + length] = data
+                col = end
+        return bytes(pixels), x, y, w, h
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        self.inFile.close()
+
+
+def clipRect(x, y, w, h, width, height):
+    """
+    Returns the part of a rectangle that is inside an image of size
+    width x height as (x, y, w, h). w or h is 0 if none of it is.
+    """
+    x0 = max(0, x)
+    y0 = max(0, y)
+    x1 = min(width, x + w)
+    y1 = min(height, y + h)
+    return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+def unpackBits(data):
+    """
+    Decompresses PackBits data
+    """
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        i = i + 1
+        if n < 128:
+            # The next n + 1 bytes are copied
+            out.extend(data[i:i + n + 1])
+            i = i + n + 1
+        elif n > 128:
+            # The next byte is repeated 257 - n times
+            out.extend(data[i:i + 1] * (257 - n))
+            i = i + 1
+    return bytes(out)
+
+
+###########################################################################
+#####                       Begin Imaging Backends                    #####
+###########################################################################
+
+# The grid reader, the score keeping and the commands use images
+# through a backend, so they can run in Fiji with ImageJ or in plain
+# python with NumPy and Pillow. Both backends hand out images and
+# processors with the few ImageJ methods the rest of the code uses:
+# images have getProcessor, getWidth, getHeight, getStackSize,
+# getBytesPerPixel, show and close, and processors have getWidth,
+# getHeight, getBitDepth, duplicate, setMinAndMax, resetMinAndMax
+# and getHistogram.
+
+
+class HeadlessImage:
+    """
+    An image that is never displayed, for processors of either
+    backend. It stands in for the images of the scoring window
+    when there is no display.
+    """
+
+    def __init__(self, processor = None):
+        self.processor = processor
+
+    def getProcessor(self):
+        return self.processor
+
+    def getWidth(self):
+        return self.processor.getWidth()
+
+    def getHeight(self):
+        return self.processor.getHeight()
+
+    def getStackSize(self):
+        return 1
+
+    def getBytesPerPixel(self):
+        return self.processor.getBitDepth() // 8
+
+    def show(self):
+        pass
+
+    def updateChannelAndDraw(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ImageJBackend:
+    """
+    Images are ImagePlus and processors are ImageProcessor
+    """
+    name = "imagej"
+
+    def openImage(self, imgPath):
+        image = ImagePlus(imgPath)
+        if image.getProcessor() is None:
+            raise ValueError("Couldn't find the image")
+        return image
+
+    def fromPixels(self, pixels, w, h, bitsPerSample, littleEndian):
+        """
+        Makes a processor from pixels read by TiffWindowReader
+        """
+        if bitsPerSample == 8:
+            return ByteProcessor(w, h, StringUtil.toBytes(pixels), None)
+        shorts = jarray.zeros(w * h, "h")
+        buf = ByteBuffer.wrap(StringUtil.toBytes(pixels))
+        if littleEndian:
+            buf.order(ByteOrder.LITTLE_ENDIAN)
+        else:
+            buf.order(ByteOrder.BIG_ENDIAN)
+        buf.asShortBuffer().get(shorts)
+        return ShortProcessor(w, h, shorts, None)
+
+    def crop(self, processor, x, y, w, h):
+        """
+        Copies a rectangle, which must be inside the image, out of a
+        processor. Unlike crop() no ROI is set on the processor, so any
+        number of threads can crop the same processor at once.
+        """
+        width = processor.getWidth()
+        pixels = processor.getPixels()
+        cropped = processor.createProcessor(w, h)
+        croppedPixels = cropped.getPixels()
+        for row in range(h):
+            System.arraycopy(pixels, (y + row) * width + x, croppedPixels, row * w, w)
+        cropped.resetMinAndMax()
+        return cropped
+
+    def newImage(self, processor):
+        """
+        Returns an image of the processor that can be shown
+        """
+        return ImagePlus(" ", processor)
+
+    def save(self, processor, fn, format = "jpeg", quality = 85):
+        """
+        Writes processor as it's displayed to fn as a JPEG of the given
+        quality (0 - 100) or as a PNG
+        """
+        image = ImagePlus(" ", processor)
+        if format == "png":
+            FileSaver(image).saveAsPng(fn)
+        else:
+            # Unlike FileSaver's, this quality isn't shared by every thread
+            JpegWriter.save(image, fn, quality)
+
+    def displayCopy(self, processor):
+        """
+        Returns an 8-bit copy of processor as it's displayed, with its
+        min and max applied
+        """
+        if processor.getBitDepth() == 8:
+            cell = processor.duplicate()
+            cell.applyTable(jarray.array(displayTable(processor.getMin(), processor.getMax()), "i"))
+        else:
+            # Scales with the min and max of the processor
+            cell = processor.convertToByte(True)
+        # The min and max are in the pixels now, so they mustn't be
+        # applied again when the copy is saved or resized
+        cell.resetMinAndMax()
+        return cell
+
+    def resize(self, processor, w, h):
+        """
+        Returns processor scaled to w x h. When it's shrunk each pixel
+        is the average of the pixels it replaces.
+        """
+        processor.setInterpolationMethod(ImageProcessor.BILINEAR)
+        return processor.resize(w, h, True)
+
+    def newSheet(self, width, height):
+        """
+        Returns a black 8-bit processor for a SpriteSheet
+        """
+        return ByteProcessor(width, height)
+
+    def paste(self, sheet, processor, x, y):
+        """
+        Copies processor into sheet at x, y. It must already be an
+        8-bit copy as it's displayed, e.g. from ThumbnailFormat.shrink.
+        """
+        sheet.insert(processor, x, y)
+
+
+class NumpyProcessor:
+    """
+    A grayscale image held in a NumPy array, with a display range
+    like an ImageJ processor
+
+    Attributes:
+    - pixels : numpy array, height x width of uint8 or uint16
+    """
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.resetMinAndMax()
+
+    def getWidth(self):
+        return self.pixels.shape[1]
+
+    def getHeight(self):
+        return self.pixels.shape[0]
+
+    def getBitDepth(self):
+        return self.pixels.dtype.itemsize * 8
+
+    def duplicate(self):
+        processor = NumpyProcessor(self.pixels.copy())
+        processor.setMinAndMax(self.min, self.max)
+        return processor
+
+    def setMinAndMax(self, theMin, theMax):
+        self.min = theMin
+        self.max = theMax
+
+    def resetMinAndMax(self):
+        if self.getBitDepth() == 8:
+            self.min, self.max = 0, 255
+        elif self.pixels.size:
+            self.min, self.max = int(self.pixels.min()), int(self.pixels.max())
+        else:
+            self.min, self.max = 0, 0
+
+    def getHistogram(self):
+        return numpy.bincount(self.pixels.ravel(),
+                              minlength=1 << self.getBitDepth()).tolist()
+
+    def displayBytes(self):
+        """
+        Returns the pixels mapped to 0 - 255 through the display
+        range, the way ImageJ shows them
+        """
+        scale = 256.0 / (self.max - self.min + 1)
+        shown = (self.pixels.astype(numpy.float64) - self.min) * scale
+        return numpy.clip(shown, 0, 255).astype(numpy.uint8)
+
+
+class NumpyBackend:
+    """
+    Images are HeadlessImage and processors are NumpyProcessor.
+    TIFFs that TiffWindowReader supports are read with it and other
+    images with Pillow, and thumbnails are written with Pillow.
+    """
+    name = "numpy"
+
+    def openImage(self, imgPath):
+        reader = TiffWindowReader(imgPath)
+        try:
+            if reader.supported:
+                pixels, x, y, w, h = reader.readWindow(0, 0, reader.width, reader.height)
+                return HeadlessImage( self.fromPixels(pixels, w, h, reader.bitsPerSample,
+                                                      reader.littleEndian) )
+        finally:
+            reader.close()
+        image = PILImage.open(imgPath)
+        if image.mode not in ("L", "I;16", "I;16B"):
+            image = image.convert("L")
+        return HeadlessImage( NumpyProcessor(numpy.array(image)) )
+
+    def fromPixels(self, pixels, w, h, bitsPerSample, littleEndian):
+        if bitsPerSample == 8:
+            dtype = numpy.uint8
+        elif littleEndian:
+            dtype = numpy.dtype("<u2")
+        else:
+            dtype = numpy.dtype(">u2")
+        return NumpyProcessor( numpy.frombuffer(pixels, dtype).reshape(h, w) )
+
+    def crop(self, processor, x, y, w, h):
+        return NumpyProcessor( processor.pixels[y:y + h, x:x + w].copy() )
+
+    def newImage(self, processor):
+        return HeadlessImage(processor)
+
+    def save(self, processor, fn, format = "jpeg", quality = 85):
+        image = PILImage.fromarray(processor.displayBytes())
+        if format == "png":
+            image.save(fn, "PNG")
+        else:
+            image.save(fn, "JPEG", quality=quality)
+
+    def displayCopy(self, processor):
+        return NumpyProcessor(processor.displayBytes())
+
+    def resize(self, processor, w, h):
+        """
+        Scales an 8-bit processor to w x h with a Lanczos filter
+        """
+        image = PILImage.fromarray(processor.pixels).resize((w, h), PILImage.LANCZOS)
+        return NumpyProcessor(numpy.array(image))
+
+    def newSheet(self, width, height):
+        return NumpyProcessor( numpy.zeros((height, width), numpy.uint8) )
+
+    def paste(self, sheet, processor, x, y):
+        h, w = processor.pixels.shape
+        sheet.pixels[y:y + h, x:x + w] = processor.pixels
+
+
+# The backends that can be used here, indexed by name
+backends = {}
+if haveImageJ:
+    backends["imagej"] = ImageJBackend()
+if numpy is not None:
+    backends["numpy"] = NumpyBackend()
+
+# The backend that is used. ImageJ is used when it's there.
+imaging = backends.get("imagej", backends.get("numpy"))
+
+
+def useBackend(name):
+    """
+    Switches to the backend called name
+    """
+    global imaging
+    if name not in backends:
+        raise ValueError("The %s backend isn't available here. Available: %s" % (
+            name, ", ".join(sorted(backends.keys()))))
+    imaging = backends[name]
+
+
+def requireImageJ(what):
+    if not haveImageJ:
+        raise ValueError("%s needs ImageJ, run it in Fiji" % what)
+
+
+def userName():
+    """
+    Returns the name of the user
+    """
+    if haveImageJ:
+        return System.getProperty("user.name")
+    return getpass.getuser()
+
+
+###########################################################################
+#####                       Begin Grid Reader                         #####
+###########################################################################
+
+
+class SourceImageCache:
+    """
+    Keeps a single copy of each source image no matter how many grids
+    were aligned on it, and keeps the memory used by source images
+    under a budget.
+
+    Images are keyed by their absolute path. A grid acquires the path
+    of its image when it is created, but the image isn't read from disk
+    until the first time a grid asks for it. When the images in memory
+    go over the budget, the least recently used ones are dropped and
+    read again the next time they are needed. An image is closed for
+    good when the last grid using it releases it.
+
+    Different images can be read and cropped by different threads at
+    the same time. Crops copy pixels out of the shared image without
+    changing it, so no lock is needed to crop.
+
+    Cells of TIFFs that TiffWindowReader supports can instead be read
+    straight from the file with window(), so the whole image never has
+    to be read.
+
+    The histogram of each image is computed once, see histogram().
+
+    Attributes:
+    - budgetMB : number, the memory in MB that source images may use.
+      If None or 0 there is no limit. The image that was asked for
+      last is always kept, even if it is bigger than the budget.
+    """
+
+    def __init__(self, budgetMB = None):
+        self.budget = None
+        if budgetMB:
+            self.budget = int(budgetMB * 1024 * 1024)
+        # These are indexed by the absolute path to the image
+        self.images = {}
+        self.sizes = {}
+        self.refCounts = {}
+        # Paths of the images in memory, least recently used first
+        self.lru = []
+        self.bytesInUse = 0
+        # The memory the images being read will take, and
+        # the memory each image takes, see imageBytes()
+        self.bytesLoading = 0
+        self.estimates = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Also indexed by path. An event is set once
+        # another thread has finished reading an image
+        self.loading = {}
+        # TiffWindowReaders, or None for images they can't read
+        self.windows = {}
+        self.histograms = {}
+        # Records how long images take to read, see Timings
+        self.timings = Timings()
+        # Held while the cache is changed
+        self.lock = threading.RLock()
+
+    def key(self, imgPath):
+        return os.path.normcase(os.path.abspath(imgPath))
+
+    def acquire(self, imgPath):
+        """
+        Registers a grid that uses the image at imgPath
+        """
+        key = self.key(imgPath)
+        with self.lock:
+            self.refCounts[key] = self.refCounts.get(key, 0) + 1
+
+    def release(self, imgPath):
+        """
+        Closes the image at imgPath if no other grid is using it
+        """
+        key = self.key(imgPath)
+        with self.lock:
+            if key not in self.refCounts:
+                return
+            self.refCounts[key] = self.refCounts[key] - 1
+            if self.refCounts[key] <= 0:
+                del self.refCounts[key]
+                if key in self.images:
+                    self.images[key].close()
+                self.evict(key)
+                if self.windows.get(key) is not None:
+                    self.windows[key].close()
+                self.windows.pop(key, None)
+
+    def window(self, imgPath):
+        """
+        Returns a TiffWindowReader for the image at imgPath, or None if
+        it can't read the image or the whole image is already in memory
+        """
+        key = self.key(imgPath)
+        with self.lock:
+            if key in self.images:
+                return None
+            if key not in self.windows:
+                reader = None
+                if key.lower().endswith((".tif", ".tiff")):
+                    try:
+                        reader = TiffWindowReader(imgPath)
+                    except EnvironmentError:
+                        reader = None
+                    if reader is not None and not reader.supported:
+                        reader.close()
+                        reader = None
+                self.windows[key] = reader
+            return self.windows[key]
+
+    def imageBytes(self, imgPath, img = None):
+        """
+        Returns the memory the image at imgPath takes once it's read,
+        from the width, height, bytes per sample and samples in its
+        TIFF header. Compressed images can take many times the size of
+        their file. If the header can't be read the size of img is
+        used, or if it isn't given the size of the file.
+        """
+        key = self.key(imgPath)
+        with self.lock:
+            if key in self.estimates:
+                return self.estimates[key]
+        size = None
+        if key.lower().endswith((".tif", ".tiff")):
+            try:
+                reader = TiffWindowReader(imgPath)
+                size = reader.imageBytes
+                reader.close()
+            except EnvironmentError:
+                size = None
+        if size is None and img is not None:
+            size = img.getWidth() * img.getHeight() * img.getStackSize() * img.getBytesPerPixel()
+        if size is None:
+            return os.path.getsize(imgPath)
+        with self.lock:
+            self.estimates[key] = size
+        return size
+
+    def fits(self, imgPath):
+        """
+        Returns True if the image at imgPath would fit in the budget
+        along with the images in memory and the ones being read
+        """
+        if self.budget is None:
+            return True
+        size = self.imageBytes(imgPath)
+        with self.lock:
+            return self.bytesInUse + self.bytesLoading + size <= self.budget
+
+    def histogram(self, imgPath, bandRows = 1024):
+        """
+        Returns the histogram of the image at imgPath. It is computed
+        the first time it's asked for and kept until the cache is
+        closed. Images that window() can read are read in bands of
+        bandRows rows instead of as a whole.
+        """
+        key = self.key(imgPath)
+        with self.lock:
+            if key in self.histograms:
+                return self.histograms[key]
+        reader = self.window(imgPath)
+        if reader is None:
+            histogram = [i for i in self.get(imgPath).getProcessor().getHistogram()]
+        else:
+            histogram = [0] * (1 << reader.bitsPerSample)
+            for top in range(0, reader.height, bandRows):
+                pixels, x, y, w, h = reader.readWindow(0, top, reader.width, bandRows)
+                band = imaging.fromPixels(pixels, w, h, reader.bitsPerSample, reader.littleEndian)
+                for value, count in enumerate(band.getHistogram()):
+                    if count:
+                        histogram[value] = histogram[value] + count
+        with self.lock:
+            self.histograms[key] = histogram
+        return histogram
+
+    def get(self, imgPath):
+        """
+        Returns the image at imgPath, reading it from disk if
+        it isn't in memory
+        """
+        key = self.key(imgPath)
+        while True:
+            with self.lock:
+                if key in self.images:
+                    self.hits = self.hits + 1
+                    self.lru.remove(key)
+                    self.lru.append(key)
+                    return self.images[key]
+                loading = self.loading.get(key)
+                if loading is None:
+                    # This thread reads the image
+                    self.misses = self.misses + 1
+                    self.loading[key] = threading.Event()
+                    break
+            # Another thread is reading the image, so wait and look again
+            loading.wait()
+        estimate = self.imageBytes(imgPath)
+        with self.lock:
+            self.bytesLoading = self.bytesLoading + estimate
+        # The image is read without holding the lock so
+        # that other images can be used in the meantime
+        try:
+            with self.timings.time("load"):
+                img = imaging.openImage(imgPath)
+        finally:
+            with self.lock:
+                self.bytesLoading = self.bytesLoading - estimate
+                self.loading.pop(key).set()
+        size = self.imageBytes(imgPath, img)
+        with self.lock:
+            self.images[key] = img
+            self.sizes[key] = size
+            self.lru.append(key)
+            self.bytesInUse = self.bytesInUse + size
+            # Make room for the new image by dropping the ones that
+            # haven't been used for the longest time
+            while self.budget is not None and self.bytesInUse > self.budget and len(self.lru) > 1:
+                self.evictions = self.evictions + 1
+                self.evict(self.lru[0])
+        return img
+
+    def evict(self, key):
+        """
+        Drops the image from memory. The image isn't closed since
+        another thread may still be cropping from it. It is freed
+        once nothing refers to it.
+        """
+        if key not in self.images:
+            return
+        self.bytesInUse = self.bytesInUse - self.sizes[key]
+        del self.images[key]
+        del self.sizes[key]
+        self.lru.remove(key)
+
+    def stats(self):
+        return "Source images: %i hits, %i misses, %i evictions, %.1f MB in memory" % (
+            self.hits, self.misses, self.evictions, self.bytesInUse / (1024.0 * 1024.0))
+
+    def __len__(self):
+        return len(self.images)
+
+
+class GridReader:
+    """
+    Displays cropped images of a plat based on a grid generated by the
+    Microarray Profile plugin:
+
+    http://www.optinav.com/MicroArray_Profile.htm
+
+    Attributes:
+    - fp : string, a path to the grid to be read. If not specified,
+           imageJ will prompt you for a path. NOTE: the filename must be
+           in the form of "sourceImageName_gridName" and should be in the form
+           generated by the Microarray Profile plugin. No more underscores
+           are allowed in the name besides the one separating the names.
+    - sourceImages : SourceImageCache, shared by grids that should
+           share source images. If not specified, the grid gets its
+           own copy of the image.
+    - grid : tuple, (rows, columns, width, xys) as returned by getGrid,
+           e.g. saved in a session file. If given the grid file isn't
+           read.
+    """
+    
+    def __init__(self, fp = None, sourceImages = None, grid = None):
+        # Initialize the filepath to the grid file
+        if fp is None:
+            self.fp = IJ.getFilePath("Grid file")
+        else:
+            self.fp = fp
+        if sourceImages is None:
+            sourceImages = SourceImageCache()
+        self.sourceImages = sourceImages
+        # Get the directory, the name of the grid, and the name of the image
+        self.initializeFilenames()
+        # The image itself isn't read until the first sub-image is opened
+        if not os.path.isfile(self.imagePath):
+            raise ValueError("Couldn't find the image")
+        self.sourceImages.acquire(self.imagePath)
+        if grid is None:
+            self.initializeGridCoords()
+        else:
+            self.setGrid(*grid)
+    
+    def initializeFilenames(self):
+        # Save the directory to the grid file
+        self.directory, gridfile = os.path.split( self.fp )
+        # Get the name of the grid file without the extension
+        # This is the "plateID" which is the concatenation of the image
+        # and the grid IDs
+        self.plateID, ext = os.path.splitext( gridfile )
+        # This expect that the grid file will be named according to
+        # imageID_plateID  This allows for multiple grids per plate
+        fnSplit = self.plateID.split("_")
+        if len(fnSplit) != 2:
+            raise ValueError("File name is not formatted properly")
+        # Save the imageID for later
+        self.imageID, tmp = fnSplit       
+        self.imagePath = os.path.join(self.directory, self.imageID + ".tif")
+    
+    def close(self):
+        """
+        This method is called by the Closing listener below
+        when the GUI frame is closed. The source image is only
+        closed if no other grid is using it.
+        """
+        self.sourceImages.release(self.imagePath)
+        
+    def initializeGridCoords(self):
+        """
+        Initializes a list of coordinates that are used by
+        the open method. self.n indexes these coordinates
+        """
+        # Read the first line of the file
+        inGrid = open(self.fp,"r")
+        reader = csv.reader(inGrid , delimiter="\t" )
+        firstLine = next(reader)
+        try:
+            rows, columns, width = [int(i) for i in firstLine]
+        except ValueError:
+            raise ValueError("There are the wrong number of fields on the first line")
+        self.setGrid(rows, columns, width, [xy for xy in reader])
+        inGrid.close()
+
+    def setGrid(self, rows, columns, width, xys):
+        """
+        Sets the size of the grid and the coordinates of its cells
+
+        Arguments:
+        - rows, columns, width : the numbers on the first line
+          of the grid file
+        - xys : list, (x, y) of each cell, a row at a time
+        """
+        self.rows = int(rows)
+        self.columns = int(columns)
+        self.width = int(width)
+        self.gridCoords = []
+        row = 1
+        col = 1
+        for x,y in xys:
+            if col > self.columns:
+                col = 1
+                row = row + 1
+            self.gridCoords.append( (self.plateID, row, col, x, y) )
+            col = col + 1
+
+    def getGrid(self):
+        """
+        Returns (rows, columns, width, xys), everything that
+        was read from the grid file
+        """
+        return (self.rows, self.columns, self.width,
+                [(coord[3], coord[4]) for coord in self.gridCoords])
+        
+    def loadSourceImage( self ):
+        """
+        Returns the image that the grid was set up on, loading
+        it if it isn't in memory
+        """
+        return self.sourceImages.get(self.imagePath)
+    
+    def openSubImage( self, x, y, auto=False ):
+        """
+        This method is called by both openPrevious and openNext to
+        display an image that is cropped from the sourceImage based
+        on the grid coordinates
+
+        Arguments:
+        - auto : bool, if True the image is autoscaled
+        """
+        # Read just the cell from the file if the image isn't in memory
+        reader = self.sourceImages.window(self.imagePath)
+        if reader is not None:
+            pixels, x0, y0, w, h = reader.readWindow( int(x), int(y), int(self.width), int(self.width) )
+            if w > 0 and h > 0:
+                processor = imaging.fromPixels(pixels, w, h, reader.bitsPerSample, reader.littleEndian)
+                return imaging.newImage(processor)
+        # Crop the cell out of the source image, clipped to its edges
+        sourceProcessor = self.loadSourceImage().getProcessor()
+        x0, y0, w, h = clipRect( int(x), int(y), int(self.width), int(self.width),
+                                 sourceProcessor.getWidth(), sourceProcessor.getHeight() )
+        if w == 0 or h == 0:
+            raise ValueError("The cell at %s, %s is outside the image" % (x, y))
+        # Make a new image of image and run contrast on it
+        openImage = imaging.newImage(imaging.crop(sourceProcessor, x0, y0, w, h))
+        return openImage
+
+    def cropAll( self, coords = None, bandRows = None ):
+        """
+        Crops every cell of the grid in one sweep down the source
+        image. The cells are cropped from top to bottom, so that each
+        band of rows of the image is only read once even if cells
+        overlap. No ROI is set on the source image, so other threads
+        can crop it at the same time.
+
+        Cells that are partly outside the image are clipped to it like
+        an ImageJ crop, and cells that are entirely outside it are
+        skipped.
+
+        Arguments:
+        - coords : list, the grid coordinates of the cells to crop, as
+          returned by getCoords. Defaults to every cell of the grid.
+        - bandRows : integer, the number of rows of the image read
+          from the file at once. Defaults to the height of 4 cells.
+
+        Yields (coord, processor) for each cell.
+        """
+        if coords is None:
+            coords = self.gridCoords
+        size = int(self.width)
+        if bandRows is None:
+            bandRows = 4 * size
+        reader = self.sourceImages.window(self.imagePath)
+        if reader is not None:
+            width, height = reader.width, reader.height
+        else:
+            sourceProcessor = self.loadSourceImage().getProcessor()
+            width, height = sourceProcessor.getWidth(), sourceProcessor.getHeight()
+        # The clipped rectangle of every cell, top to bottom
+        cells = []
+        for coord in coords:
+            x0, y0, w, h = clipRect( int(coord[3]), int(coord[4]), size, size, width, height )
+            if w > 0 and h > 0:
+                cells.append( (y0, x0, w, h, coord) )
+        cells.sort(key=lambda cell: (cell[0], cell[1]))
+        if reader is None:
+            # The whole image is in memory
+            for y0, x0, w, h, coord in cells:
+                yield coord, imaging.crop(sourceProcessor, x0, y0, w, h)
+            return
+        bpp = reader.bytesPerPixel
+        band = None
+        bandTop = bandBottom = 0
+        for y0, x0, w, h, coord in cells:
+            if band is None or y0 + h > bandBottom:
+                # Read the rows from the top of this cell down
+                band, bx, bandTop, bw, bh = reader.readWindow( 0, y0, width, max(bandRows, h) )
+                bandBottom = bandTop + bh
+            pixels = []
+            for row in range(y0, y0 + h):
+                start = ((row - bandTop) * width + x0) * bpp
+                pixels.append( band[start:start + w * bpp] )
+            yield coord, imaging.fromPixels(b"".join(pixels), w, h, reader.bitsPerSample, reader.littleEndian)
+
+    def getCoords(self):
+        return self.gridCoords
+
+    def getPlateID(self):
+        return self.plateID
+    
+
+            
+
+class WellTable:
+    """
+    Every well of every grid in a session, kept in parallel arrays so
+    that a session with thousands of wells stays small.
+
+    Each well gets an integer well ID, which is its index in the
+    arrays. Wells can be looked up by (plateID, row, col) in constant
+    time, whether the row and column are numbers or strings read from
+    a score file. A bitmap keeps track of the wells that have a score.
+    """
+
+    def __init__(self):
+        # The plateIDs, indexed by plate number
+        self.plates = []
+        self.plateNumbers = {}
+        # These are indexed by the well ID
+        self.plate = array("i")
+        self.row = array("i")
+        self.col = array("i")
+        self.x = array("i")
+        self.y = array("i")
+        self.status = bytearray()
+        # Well IDs indexed by (plate number, row, col)
+        self.index = {}
+
+    def add(self, plateID, row, col, x, y):
+        """
+        Adds a well and returns its well ID. A well that is
+        already in the table keeps its ID.
+        """
+        if plateID not in self.plateNumbers:
+            self.plateNumbers[plateID] = len(self.plates)
+            self.plates.append(plateID)
+        plate = self.plateNumbers[plateID]
+        key = (plate, int(row), int(col))
+        if key in self.index:
+            return self.index[key]
+        wellID = len(self.plate)
+        self.plate.append(plate)
+        self.row.append(int(row))
+        self.col.append(int(col))
+        self.x.append(int(x))
+        self.y.append(int(y))
+        if wellID % 8 == 0:
+            self.status.append(0)
+        self.index[key] = wellID
+        return wellID
+
+    def find(self, plateID, row, col):
+        """
+        Returns the well ID of a well, or None if it isn't in the table
+        """
+        plate = self.plateNumbers.get(plateID)
+        if plate is None:
+            return None
+        try:
+            return self.index.get((plate, int(row), int(col)))
+        except ValueError:
+            return None
+
+    def plateID(self, wellID):
+        return self.plates[ self.plate[wellID] ]
+
+    def coord(self, wellID):
+        """
+        Returns the well as a tuple: (plateID, row, col, x, y)
+        """
+        return (self.plates[ self.plate[wellID] ], self.row[wellID],
+                self.col[wellID], self.x[wellID], self.y[wellID])
+
+    def isScored(self, wellID):
+        return bool(self.status[wellID >> 3] & (1 << (wellID & 7)))
+
+    def setScored(self, wellID):
+        self.status[wellID >> 3] = self.status[wellID >> 3] | (1 << (wellID & 7))
+
+    def __len__(self):
+        return len(self.plate)
+
+
+def thumbnailName(plateID, row, col, extension = ".jpg"):
+    """
+    Returns the file name of the thumbnail of a cell
+    """
+    return "_".join([ str(plateID), str(row), str(col) ] ) + extension
+
+
+def scorerFileName(fn, scorer):
+    """
+    Returns fn with the name of the scorer added to it (e.g.
+    "scores-alice.csv"), or fn if it's already there
+    """
+    base, extension = os.path.splitext(fn)
+    suffix = "-" + safeName(scorer)
+    if base.endswith(suffix):
+        return fn
+    return base + suffix + extension
+
+
+def fileHash(fn):
+    """
+    Returns the MD5 of a file as a hex string
+    """
+    inFile = open(fn, "rb")
+    digest = hashlib.md5(inFile.read()).hexdigest()
+    inFile.close()
+    return digest
+
+
+def readSessionFile(sessionFile):
+    """
+    Reads a session file written by GridSet.writeSession. Settings are
+    returned by name, and the rows for grids and for the min and max
+    typed in for wells are returned as lists under "grid" and
+    "override". Nothing but the empty lists is returned if there is
+    no session file.
+    """
+    session = {"grid" : [], "override" : []}
+    if os.path.isfile(sessionFile):
+        inFile = open(sessionFile, "r")
+        for row in csv.reader(inFile, delimiter="\t"):
+            if len(row) == 2:
+                session[row[0]] = row[1]
+            elif len(row) > 2 and row[0] in session:
+                session[row[0]].append(row[1:])
+            elif len(row) > 2:
+                session[row[0]] = row[1:]
+        inFile.close()
+    return session
+
+
+def resumeSession(sessionFile, **kwargs):
+    """
+    Returns a GridSet that picks up a session where it was left, with
+    the grids, score file and settings saved in its session file.
+    Other arguments are passed on to GridSet.
+    """
+    session = readSessionFile(sessionFile)
+    if "scoreFile" not in session:
+        raise ValueError("%s doesn't say which score file it belongs to. "
+                         "Choose the grids instead." % sessionFile)
+    directory = os.path.dirname(os.path.abspath(sessionFile))
+    scoreFile = os.path.join(directory, session["scoreFile"])
+    thumbDir = os.path.join(directory, session["thumbDir"])
+    return GridSet(None, scoreFile, thumbDir, **kwargs)
+
+
+class GridSet:
+    """
+    A class to keep track of multiple grid readers.
+    
+    cContains methods to keep track of scores and move forward and
+    backward while keeping track of the scores.
+
+    Writes a csv file containing the information about the grid as well
+    as the score that was assigned to each cell in the grid.
+
+    Writes a jpg thumbnail for each cropped cell in the grid, or
+    sprite sheets of them (see writeSprites).
+
+    Writes an HTML report that matches scores to images.
+
+    Images are displayed randomly to prevent biased scoring. With the
+    "random" order every cell of every plate is shuffled together.
+    With the "blocked" order the images are split into random blocks
+    of a few images each and the cells are shuffled within each block,
+    so only a few images need to be in memory at a time while
+    consecutive cells still come from random plates and positions.
+    The order is drawn from a seed that is saved next to the score
+    file, so a restored session picks up the same order.
+
+    The session file (e.g. "scores.session") is a manifest of the
+    session: the grids with their modification times and MD5s and
+    their coordinates, the order settings, the well that was open,
+    the contrast settings and where the scores are kept. It is written
+    when the GridSet is made and when it's closed. Passing None for the
+    grids resumes the session in it (see resumeSession), and grids that
+    haven't changed since it was written aren't read again.
+
+    The min and max of each cell can be set automatically. With the
+    "plate" contrast every cell of an image is shown with the range
+    that holds all but the darkest and brightest 0.5% of the pixels of
+    the image, and with the "well" contrast the same is done for the
+    pixels of each cell. The ranges of all the cells of a plate are
+    computed at once, the first time one of them is needed. A min or
+    max typed in for a cell overrides the automatic one for that cell.
+    With the "manual" contrast the min and max that were typed in last
+    are used for every cell.
+
+    Arguments:
+
+    - fp : list, paths the the grid files used by the GridReader. If
+      None the grids in the session file are used.
+    - scoreFile : string, an string giving the filename of the
+      scores to write to.
+    - thumbDir : string, the name of the directory to save the
+      thumbnails in
+    - syncEvery : integer, how many scores are journaled between
+      each fsync. See ScoreJournal.
+    - cacheMB : number, the memory in MB that source images may use.
+      If None or 0 there is no limit. See SourceImageCache.
+    - order : string, "random" (the default) or "blocked"
+    - blockSize : integer, the number of images in each block of
+      the "blocked" order, 4 by default. At least 2 images are used
+      per block.
+    - seed : integer, the seed for the order. If not specified a new
+      one is drawn. Restored sessions keep the order, block size and
+      seed they were saved with.
+    - prefetch : integer, the number of cells to crop in the background
+      ahead of the current one. See Prefetcher.
+    - keepBehind : integer, the number of cells to keep in memory
+      behind the current one for the previous button
+    - contrast : string, "manual" (the default), "plate" or "well"
+    - database : string, a score database to keep the scores in
+      instead of a journal, see ScoreDatabase. The score file is
+      still written from it when the GridSet is closed. The name of
+      the scorer is added to the score file and thumbDir (e.g.
+      "scores-alice.csv"), so scorers sharing a database don't write
+      over each other's score files, sessions, reports and thumbnails.
+    - scorer : string, the name to save scores under in the database.
+      Defaults to the scorer of the session, or else the name of the
+      user.
+    - timing : bool, if True how long each step takes is recorded and
+      written next to the score file when the GridSet is closed (e.g.
+      "scores-timings.json"). See Timings.
+    - sprites : string, "well" (the default) to write a thumbnail for
+      each well as it's scored, or "plate" or "score" to pack the thumbnails of the
+      scored wells into sprite sheets of each plate or each score when
+      the GridSet is closed. See writeSprites.
+    - thumbnailFormat : ThumbnailFormat, the size and format of the
+      thumbnails. Defaults to 300 pixel JPEGs, the size the reports
+      show them at.
+
+    The contrast, sprites, thumbnailFormat and database that aren't
+    given are taken from the session file, if there is one.
+    """
+    def __init__(self, fp, scoreFile, thumbDir, syncEvery = 1, cacheMB = None,
+                 order = None, blockSize = None, seed = None,
+                 prefetch = 3, keepBehind = 2, contrast = None,
+                 database = None, scorer = None, timing = False,
+                 sprites = None, thumbnailFormat = None):
+        self.timings = Timings(timing)
+        # These will be indexed by the well ID
+        self.scores = {}
+        # The wells that have a score, in the order they were scored
+        self.scored = []
+        # Scores of wells that aren't on any of the grids, indexed by
+        # (plate, row, col). They're kept so they aren't lost from the
+        # score file.
+        self.otherScores = {}
+        # These will be indexed by the plateID
+        self.grids = {}
+        # Grids aligned on the same image share a single copy of it
+        self.sourceImages = SourceImageCache(cacheMB)
+        self.sourceImages.timings = self.timings
+        # Every well of every grid. gridCoords holds well IDs
+        # in the order they are displayed
+        self.wells = WellTable()
+        self.gridCoords = []
+        # The settings of a previous session are used for the
+        # arguments that aren't given
+        self.sessionFile = os.path.splitext(scoreFile)[0] + ".session"
+        session = readSessionFile(self.sessionFile)
+        if fp is None:
+            fp = [record[0] for record in session["grid"]]
+            if not fp:
+                raise ValueError("There are no grids in %s" % self.sessionFile)
+        if not database and "database" in session:
+            database = os.path.join(os.path.dirname(os.path.abspath(self.sessionFile)),
+                                    session["database"])
+        if database:
+            # Scorers sharing a database each get their own score file,
+            # session, reports and thumbnails
+            database = os.path.abspath(database)
+            if not scorer:
+                scorer = session.get("scorer") or userName()
+            scoreFile = scorerFileName(scoreFile, scorer)
+            thumbDir = scorerFileName(thumbDir, scorer)
+            if os.path.splitext(scoreFile)[0] + ".session" != self.sessionFile:
+                self.sessionFile = os.path.splitext(scoreFile)[0] + ".session"
+                session = readSessionFile(self.sessionFile)
+        if contrast is None:
+            contrast = session.get("contrast", "manual")
+        if sprites is None:
+            sprites = session.get("sprites", "well")
+        if sprites not in ("well", "plate", "score"):
+            raise ValueError("Unknown sprites: %s" % sprites)
+        self.sprites = sprites
+        if thumbnailFormat is None and "thumbSize" in session:
+            thumbnailFormat = ThumbnailFormat(int(session["thumbSize"]), session["thumbFormat"],
+                                              int(session["jpegQuality"]),
+                                              session["fullSize"] == "1")
+        elif thumbnailFormat is None:
+            thumbnailFormat = ThumbnailFormat()
+        self.thumbnailFormat = thumbnailFormat
+        # (mtime, md5) of each grid file, indexed by its absolute path
+        self.gridStamps = {}
+        for i in fp:
+            with self.timings.time("parse"):
+                grid = GridReader(i, self.sourceImages, self.savedGrid(i, session))
+            # each coordinate is a tuple: (plateID, row, col, x, y)
+            gridCoords = grid.getCoords()
+            # save the grid reader in a dictionary
+            self.grids[ grid.getPlateID() ] = grid
+            # append the wells to the coordinates pile
+            for coord in gridCoords:
+                self.gridCoords.append( self.wells.add(*coord) )
+        # The order can't change in the middle of a session, since
+        # the scores already given follow it
+        for name, value in (("order", order), ("blockSize", blockSize), ("seed", seed)):
+            if value is not None and name in session and session[name] != str(value):
+                print("Keeping the %s of %s: %s" % (name, self.sessionFile, session[name]))
+        self.order = session.get("order", order or "random")
+        self.blockSize = int(session.get("blockSize", blockSize or 4))
+        if "seed" in session:
+            self.seed = int(session["seed"])
+        elif seed is not None:
+            self.seed = seed
+        else:
+            self.seed = Random().randint(0, 2**31 - 1)
+        # shuffle the coordinates
+        self.gridCoords = array("i", self.orderCoords(self.gridCoords))
+        # Initialize the images, and some variable names
+        self.openImage = HeadlessImage()
+        # Whether a well has been opened yet
+        self.opened = False
+        self.thumbDir = thumbDir
+        self.scoreFile = scoreFile
+        if database:
+            self.journal = ScoreDatabase(database, scoreFile, scorer, syncEvery)
+            self.journal.addWells([self.wells.coord(wellID) for wellID in self.gridCoords])
+        else:
+            self.journal = ScoreJournal(scoreFile, syncEvery)
+        self.reportFile = os.path.splitext(scoreFile)[0] + ".html"
+        self.reportFile2 = os.path.splitext(scoreFile)[0] + "-with-plate-positions.html"
+        self.timingFile = os.path.splitext(scoreFile)[0] + "-timings.json"
+        self.min = 0
+        self.max = 255
+        if contrast not in ("manual", "plate", "well"):
+            raise ValueError("Unknown contrast: %s" % contrast)
+        self.contrast = contrast
+        # The automatic min and max of each well, indexed by the
+        # well ID. -1 until the ranges of its plate are computed
+        self.autoMin = array("i", [-1]) * len(self.wells)
+        self.autoMax = array("i", [-1]) * len(self.wells)
+        # These are indexed by the plateID
+        self.plateRanges = {}
+        self.rangedPlates = {}
+        # Held while the ranges of a plate are computed, indexed by
+        # the plateID. rangeLock is held while one is made.
+        self.rangeLocks = {}
+        self.rangeLock = threading.Lock()
+        self.loader = None
+        # The min and max typed in for a well, indexed by the well ID
+        self.overrides = {}
+        # This is the current coordinate position
+        self.n = -1
+        # Test for scorefiles
+        if self.journal.exists():
+            print("Restoring previous scores")
+            self.restoreScores()
+        self.restoreSession(session)
+        self.database = database
+        self.scorer = scorer
+        self.writeSession()
+        if database:
+            self.journal.saveOrder([self.wells.coord(wellID) for wellID in self.gridCoords])
+        # Started after the scores are restored, since
+        # that changes the order of the coordinates
+        self.prefetcher = Prefetcher(self.cropCell, prefetch, keepBehind,
+                                     len(self.gridCoords))
+        self.thumbnails = ThumbnailWriter(timings=self.timings,
+                                          thumbnailFormat=self.thumbnailFormat)
+        # Generate a spot for the HTML report to live in along with the thumbnails
+        try:
+            os.mkdir(self.thumbDir)
+        except OSError:
+            pass
+
+    def savedGrid(self, fp, session):
+        """
+        Returns the grid saved in the session for the grid file fp, as
+        for GridReader, or None if the file has changed since and has
+        to be read again. The file is only hashed if its modification
+        time has changed.
+        """
+        path = os.path.abspath(fp)
+        mtime = repr(os.path.getmtime(path))
+        for record in session["grid"]:
+            if record[0] != path or len(record) != 7:
+                continue
+            savedTime, savedHash, rows, columns, width, xys = record[1:]
+            if savedTime != mtime:
+                if fileHash(path) != savedHash:
+                    return None
+            self.gridStamps[path] = (mtime, savedHash)
+            return rows, columns, width, [xy.split(",") for xy in xys.split()]
+        return None
+
+    def restoreSession(self, session):
+        """
+        Goes back to the well that was open and the min and max that
+        were set when the session was saved. If scores were written
+        after that (e.g. Fiji crashed before the session was saved
+        again) the position and the min and max restoreScores found
+        are kept instead.
+        """
+        for plateID, row, col, theMin, theMax in session["override"]:
+            wellID = self.wells.find(plateID, row, col)
+            if wellID is not None:
+                self.overrides[ wellID ] = (int(theMin), int(theMax))
+        lastScore = self.journal.lastWritten()
+        if (lastScore is not None and os.path.isfile(self.sessionFile)
+                and lastScore > os.path.getmtime(self.sessionFile)):
+            print("%s is older than the scores, going on after the last score" % self.sessionFile)
+            return
+        if "min" in session:
+            self.min = int(session["min"])
+            self.max = int(session["max"])
+        if "current" in session:
+            wellID = self.wells.find(*session["current"])
+            if wellID is not None:
+                # openNext opens the position after n
+                self.n = self.gridCoords.index(wellID) - 1
+
+    def writeSession(self):
+        """
+        Saves the manifest of the session next to the score file
+        """
+        rows = []
+        rows.append(["scoreFile", os.path.basename(self.scoreFile)])
+        rows.append(["thumbDir", os.path.basename(self.thumbDir)])
+        if self.database:
+            rows.append(["database", self.database])
+            rows.append(["scorer", self.scorer])
+        rows.append(["order", self.order])
+        rows.append(["blockSize", self.blockSize])
+        rows.append(["seed", self.seed])
+        rows.append(["contrast", self.contrast])
+        rows.append(["sprites", self.sprites])
+        rows.append(["thumbSize", self.thumbnailFormat.size])
+        rows.append(["thumbFormat", self.thumbnailFormat.format])
+        rows.append(["jpegQuality", self.thumbnailFormat.quality])
+        rows.append(["fullSize", int(self.thumbnailFormat.full)])
+        rows.append(["min", self.min])
+        rows.append(["max", self.max])
+        # The open well, or the one openNext opens when none is open yet
+        current = self.n
+        if not self.opened:
+            current = current + 1
+        if 0 <= current < len(self.gridCoords):
+            rows.append(["current"] + [i for i in self.wells.coord(self.gridCoords[current])[:3]])
+        for wellID, (theMin, theMax) in sorted(self.overrides.items()):
+            rows.append(["override"] + [i for i in self.wells.coord(wellID)[:3]] + [theMin, theMax])
+        for plateID in sorted(self.grids.keys()):
+            grid = self.grids[plateID]
+            path = os.path.abspath(grid.fp)
+            if path not in self.gridStamps:
+                self.gridStamps[path] = (repr(os.path.getmtime(path)), fileHash(path))
+            mtime, digest = self.gridStamps[path]
+            gridRows, gridColumns, width, xys = grid.getGrid()
+            rows.append(["grid", path, mtime, digest, gridRows, gridColumns, width,
+                         " ".join(["%s,%s" % (x, y) for x, y in xys])])
+        out = open(self.sessionFile, "w")
+        writer = csv.writer(out, delimiter="\t")
+        for row in rows:
+            writer.writerow(row)
+        out.close()
+
+    def orderCoords(self, wellIDs):
+        """
+        Returns the well IDs in the order they will be displayed.
+        The same wells, order settings and seed always give the
+        same order.
+        """
+        rng = Random(self.seed)
+        def shuffled(items):
+            # A Fisher-Yates shuffle that only relies on random()
+            # so the same seed gives the same order in any python
+            items = [i for i in items]
+            for i in range(len(items) - 1, 0, -1):
+                j = int(rng.random() * (i + 1))
+                items[i], items[j] = items[j], items[i]
+            return items
+        # Start from the same order no matter what order
+        # the grid files were chosen in
+        wells = self.wells
+        wellIDs = sorted(wellIDs, key=lambda i: (wells.plateID(i), wells.row[i], wells.col[i]))
+        if self.order == "random":
+            return shuffled(wellIDs)
+        if self.order != "blocked":
+            raise ValueError("Unknown order: %s" % self.order)
+        # Group the wells by the image they are cropped from
+        byImage = {}
+        for wellID in wellIDs:
+            imgPath = self.grids[ wells.plateID(wellID) ].imagePath
+            byImage.setdefault(imgPath, []).append(wellID)
+        images = shuffled(sorted(byImage.keys()))
+        blockSize = max(2, self.blockSize)
+        result = []
+        for i in range(0, len(images), blockSize):
+            block = []
+            for imgPath in images[i:i + blockSize]:
+                block.extend(byImage[imgPath])
+            result.extend(shuffled(block))
+        return result
+
+    def restoreScores(self):
+        """
+        If a file with the same name is detected as the output score file,
+        this method is called. It reads in the previous scores and
+        sets the first image to be the image after the previous scores.
+        Scores left in the journal by a session that wasn't closed are
+        replayed on top of the score file, and the last score for a
+        well wins.
+        """
+        # for each row in the scores file and the journal, look up
+        # the well and make an entry for the score
+        for record in self.journal.replay():
+            plateID, row, col, x, y, theMin, theMax, score = record
+            wellID = self.wells.find(plateID, row, col)
+            if wellID is None:
+                self.otherScores[ (plateID, row, col) ] = tuple(record)
+                continue
+            if not self.wells.isScored(wellID):
+                self.wells.setScored(wellID)
+                self.scored.append(wellID)
+            plateID, row, col, x, y = self.wells.coord(wellID)
+            self.scores[ wellID ] = (plateID, row, col, x, y, theMin, theMax, score)
+        if len(self.scored) == 0:
+            return
+        self.min = int(theMin)
+        self.max = int(theMax)
+        # The scored wells come first, then the rest in their order
+        self.n = len(self.scored) - 1
+        order = array("i", self.scored)
+        for wellID in self.gridCoords:
+            if not self.wells.isScored(wellID):
+                order.append(wellID)
+        self.gridCoords = order
+        
+    def writeThumbnail(self):
+        """
+        Queues a thumbnail of the current image with the
+        current min and max to be written. With sprite sheets
+        they're made when the GridSet is closed instead.
+        """
+        if self.sprites != "well":
+            return
+        plateID, row, col, x, y = self.currentCoordinate
+        imName = os.path.join(self.thumbDir, self.thumbnailFormat.name(plateID, row, col))
+        # Copy the image so that later changes to it
+        # don't end up in a thumbnail that's still queued
+        processor = self.openImage.getProcessor().duplicate()
+        processor.setMinAndMax(self.min, self.max)
+        self.thumbnails.write(processor, imName)
+
+    def plateRange(self, plateID):
+        """
+        Returns the min and max of the plate from the
+        histogram of its image
+        """
+        if plateID not in self.plateRanges:
+            imagePath = self.grids[ plateID ].imagePath
+            self.plateRanges[ plateID ] = percentileRange(self.sourceImages.histogram(imagePath))
+        return self.plateRanges[ plateID ]
+
+    def computeWellRanges(self, plateID):
+        """
+        Computes the min and max of every well of the plate from
+        their histograms, cropping the whole plate in one sweep
+        """
+        with self.rangeLock:
+            if plateID not in self.rangeLocks:
+                self.rangeLocks[ plateID ] = threading.Lock()
+        with self.rangeLocks[ plateID ]:
+            if plateID in self.rangedPlates:
+                return
+            for coord, processor in self.grids[ plateID ].cropAll():
+                wellID = self.wells.find(coord[0], coord[1], coord[2])
+                theMin, theMax = percentileRange(processor.getHistogram())
+                self.autoMin[ wellID ] = theMin
+                self.autoMax[ wellID ] = theMax
+            self.rangedPlates[ plateID ] = True
+
+    def loadPlate(self, plateID):
+        """
+        Gets a plate ready to be shown: reads its image if cells can't
+        be read straight from the file and it fits in memory, and
+        computes its automatic min and max
+        """
+        imagePath = self.grids[ plateID ].imagePath
+        if self.sourceImages.window(imagePath) is None and self.sourceImages.fits(imagePath):
+            self.sourceImages.get(imagePath)
+        if self.contrast == "plate":
+            self.plateRange(plateID)
+        elif self.contrast == "well":
+            self.computeWellRanges(plateID)
+
+    def loadPlates(self, workers = None, progress = None):
+        """
+        Starts loading every plate in the background, in the order
+        their first cells come up. The number of threads is limited by
+        the number of processors and by how many of the biggest images
+        fit in the memory budget at once.
+
+        Arguments:
+        - workers : integer, the most threads. Defaults to the
+          number of processors.
+        - progress : function, see PlateLoader
+        """
+        if workers is None:
+            workers = cpuCount()
+        budget = self.sourceImages.budget
+        if budget is not None:
+            biggest = max([self.sourceImages.imageBytes(grid.imagePath)
+                           for grid in self.grids.values()])
+            workers = max(1, min(workers, budget // max(1, biggest)))
+        plateIDs = []
+        seen = {}
+        for wellID in self.gridCoords[ max(0, self.n):]:
+            plateID = self.wells.plateID(wellID)
+            if plateID not in seen:
+                seen[ plateID ] = True
+                plateIDs.append(plateID)
+        self.loader = PlateLoader(self.loadPlate, plateIDs, workers, progress)
+
+    def wellRange(self, wellID):
+        """
+        Returns the min and max to show the well with
+        """
+        if wellID in self.overrides:
+            return self.overrides[ wellID ]
+        if self.contrast == "manual":
+            return self.min, self.max
+        plateID = self.wells.plateID(wellID)
+        if self.contrast == "well":
+            self.computeWellRanges(plateID)
+            if self.autoMin[ wellID ] >= 0:
+                return self.autoMin[ wellID ], self.autoMax[ wellID ]
+        return self.plateRange(plateID)
+
+    def setMinAndMax(self, minVal = None, maxVal = None):
+        """
+        Sets the min and max of the current image. With automatic
+        contrast a min or max that is passed in overrides the
+        automatic one for the current well.
+
+        Arguments:
+        - minVal : integer, the minimum value for the pixel display
+        - maxVal : integer, the maximum value for the pixel display
+        """
+        if minVal is not None:
+            self.min = minVal
+        if maxVal is not None:
+            self.max = maxVal
+        if self.contrast != "manual" and (minVal is not None or maxVal is not None):
+            self.overrides[ self.currentWell ] = (self.min, self.max)
+        self.openImage.getProcessor().setMinAndMax(self.min, self.max)
+        self.openImage.updateChannelAndDraw()
+        self.writeThumbnail()
+            
+    def cropCell(self, n):
+        """
+        Crops the cell at position n and applies the current
+        min and max. This is called by the prefetcher.
+        """
+        wellID = self.gridCoords[ n ]
+        plateID, row, col, x, y = self.wells.coord(wellID)
+        with self.timings.time("crop"):
+            processor = self.grids[ plateID ].openSubImage(x, y).getProcessor()
+        theMin, theMax = self.wellRange(wellID)
+        processor.setMinAndMax(theMin, theMax)
+        return processor
+
+    def openCell(self, n):
+        """
+        Returns an image of the cell at position n. The prefetched
+        crop is used if it's ready, otherwise the cell is cropped now.
+        """
+        processor = self.prefetcher.take(n)
+        if processor is None:
+            self.timings.count("prefetchMisses")
+            processor = self.cropCell(n)
+            self.prefetcher.put(n, processor)
+        else:
+            self.timings.count("prefetchHits")
+        self.prefetcher.moveTo(n)
+        # The kept processor is copied since closing
+        # the displayed image may flush its pixels
+        return imaging.newImage(processor.duplicate())
+
+    def openNext(self):
+        """
+        Opens the next image.
+
+        Arguments:
+        - thumbNails : bool, if True a thumbnail for th
+          image is written when the image is opened
+        """
+        self.openImage.close()
+        # Set the current number being examined
+        self.n = self.n + 1
+        try:
+            self.currentWell = self.gridCoords[ self.n ]
+        except IndexError:
+            if haveImageJ:
+                gd = GenericDialog("")
+                gd.addMessage("No more images")
+                gd.showDialog()
+            else:
+                print("No more images")
+            return None
+        self.currentCoordinate = self.wells.coord(self.currentWell)
+        # open the file
+        with self.timings.time("open"):
+            self.openImage = self.openCell(self.n)
+        self.opened = True
+        self.min, self.max = self.wellRange(self.currentWell)
+        # This also writes the thumbnail
+        self.setMinAndMax()
+        with self.timings.time("show"):
+            self.openImage.show()
+        self.timings.sampleMemory()
+        # Try to return the information about the current score
+        # if it doesn't exist, return an empty string. This
+        # is used to display the score associated with the image
+        try:
+            return self.scores[ self.currentWell ][7]
+        except KeyError:
+            return ""
+
+    def openPrevious(self):
+        """
+        Opens the previous image.
+        """
+        self.n = self.n - 1
         if self.n < 0:
             self.n = 0
         else:
             self.openImage.close()
-            self.currentCoordinate = self.gridCoords[ self.n ]
-            plateID, row, col, x, y = self.currentCoordinate
+            self.currentWell = self.gridCoords[ self.n ]
+            self.currentCoordinate = self.wells.coord(self.currentWell)
             # open the file
-            grid = self.grids[ plateID ]
-            self.openImage = grid.openSubImage(x,y)
+            with self.timings.time("open"):
+                self.openImage = self.openCell(self.n)
+            self.opened = True
+            self.min, self.max = self.wellRange(self.currentWell)
             self.setMinAndMax()
-            self.openImage.show()
+            with self.timings.time("show"):
+                self.openImage.show()
+            self.timings.sampleMemory()
         # Retun the score of the image so it can be displayed
         try:
-            return self.scores[ self.currentCoordinate ][7]
+            return self.scores[ self.currentWell ][7]
         except KeyError:
             return ""
 
     def writeScore(self, score):
         """
         Update the dictionary of scores with the new score and
-        write the full dictionary to disk.
+        append it to the journal. The full dictionary is written
+        to the score file when the GridSet is closed.
 
         Attributes:
         - score : string, the score to be associated with the grid
                   coordinates and the row/column info
         """
-        header = ["plate", "row", "col", "x", "y", "min", "max", "score"]
         plateID, row, col, x, y = self.currentCoordinate
         # Save the info for the score in a dictionary
         info = (plateID,
@@ -659,74 +3172,1574 @@ class GridSet:
                 self.min,
                 self.max,
                 score)
-        self.scores[ self.currentCoordinate ] = info
-        # initialize a writer for the scores and write a header
-        self.out = open( self.scoreFile , "w" )
-        writer = csv.writer(self.out, delimiter=",")
-        writer.writerow(header)
-        for i in self.scores.values():
-            writer.writerow( i )
-        self.out.close() 
+        if not self.wells.isScored(self.currentWell):
+            self.wells.setScored(self.currentWell)
+            self.scored.append(self.currentWell)
+        self.scores[ self.currentWell ] = info
+        with self.timings.time("score"):
+            self.journal.record(info)
+
+    def writeSprites(self, cellsPerSheet = 100, columns = 10):
+        """
+        Packs a thumbnail of every scored well, with the min and max it
+        was scored with, into sprite sheets in the thumbnail directory.
+        With sprites="plate" each plate gets its own sheets, and with
+        sprites="score" each score does, in the order of the report.
+        The sheets are filled one at a time, and the wells of each
+        plate on a sheet are cropped in one sweep down its image.
+        sprites.tsv says where each well is, see writeSpriteIndex.
+
+        Returns the index of the wells on the sheets, see spriteIndex
+        """
+        # These are indexed by (plate, row, col)
+        wellIDs = {}
+        # The keys of each group, in the order they go on the sheets
+        groups = {}
+        names = []
+        cellSize = 1
+        for wellID, info in sorted(self.scores.items(), key=lambda item: item[1][7]):
+            key = (info[0], int(info[1]), int(info[2]))
+            wellIDs[key] = wellID
+            if self.sprites == "plate":
+                name = info[0]
+            else:
+                name = "score-" + str(info[7])
+            if name not in groups:
+                groups[name] = []
+                names.append(name)
+            groups[name].append(key)
+            cellSize = max(cellSize, int(self.grids[ info[0] ].width))
+        if self.sprites == "plate":
+            names.sort()
+            for name in names:
+                groups[name].sort()
+        thumbnailFormat = self.thumbnailFormat
+        sheets = planSpriteSheets(self.thumbDir, [(name, groups[name]) for name in names],
+                                  cellSize, cellsPerSheet, columns, thumbnailFormat)
+        for sheet in sheets:
+            byPlate = {}
+            for key in sheet.keys:
+                byPlate.setdefault(key[0], []).append( self.wells.coord(wellIDs[key]) )
+            for plateID, coords in byPlate.items():
+                for coord, processor in self.grids[ plateID ].cropAll(coords):
+                    key = (coord[0], int(coord[1]), int(coord[2]))
+                    info = self.scores[ wellIDs[key] ]
+                    processor.setMinAndMax(int(info[5]), int(info[6]))
+                    sheet.paste(key, thumbnailFormat.shrink(processor))
+                    if thumbnailFormat.full:
+                        thumbnailFormat.writeFull(processor, os.path.join(
+                            self.thumbDir, thumbnailFormat.name(*key)))
+            sheet.save()
+            if self.timings.enabled and os.path.isfile(sheet.fn):
+                self.timings.count("thumbnailBytes", os.path.getsize(sheet.fn))
+        writeSpriteIndex(os.path.join(self.thumbDir, "sprites.tsv"), sheets)
+        return spriteIndex(sheets)
 
     def writeReport(self, reportName, thumbDir, numColumns = 5, textSize = 20, doInfo=False):
         """
         Writes an HTML report with alternating rows of
-        images and their scores.
+        images and their scores. See writeReports.
+        """
+        self.writeReports([(reportName, doInfo)], thumbDir, numColumns, textSize)
+
+    def writeReports(self, reports, thumbDir, numColumns = 5, textSize = 20,
+                     pageBy = "score", pageSize = 500, thumbSize = None,
+                     sprites = None):
+        """
+        Writes HTML reports with alternating rows of images and their
+        scores. Each report is an index page that links to pages of
+        images. With pageBy="score" each score gets its own pages,
+        otherwise the pages follow each other in order of the scores.
+        Images are only loaded by the browser when they are scrolled to.
+
+        Every report is written in the same pass over the scores, and
+        each row is written to the files as soon as it is made.
 
         Arguments:
+        - reports : list, (reportName, doInfo) pairs. If doInfo is True
+          the plate, row and column are shown under each score
         - numColumns : integer, the number of columns in the html report
         - textSize : integer, the text size for the scores
+        - pageBy : string, "score" or None
+        - pageSize : integer, the most images on a page
+        - thumbSize : integer, the width and height the images are shown
+          at. Defaults to the size of the thumbnails.
+        - sprites : dict, where the wells are on sprite sheets, as
+          returned by writeSprites. Wells on a sheet are shown from it
+          instead of from their own thumbnail.
         """
+        if thumbSize is None:
+            thumbSize = self.thumbnailFormat.size or 300
         def img(location, width, height):
-            return '<img src="%s" width="%i" height="%i">' % (location, width, height)
-        # Initialize the HTML writer
-        t = Table(col_align = ["center" for i in range(0,numColumns)])
-        #t.rows.append(TableRow(["row", "col", "score", "image"], header=True))
+            return '<img src="%s" width="%i" height="%i" loading="lazy" decoding="async">' % (
+                location, width, height)
+        def sprite(location, x, y, w, h, sheetWidth, sheetHeight, size):
+            # The region of the sheet is stretched to size like the images
+            scaleX = size / float(w)
+            scaleY = size / float(h)
+            return ('<div style="display:inline-block;width:%ipx;height:%ipx;'
+                    'background:url(%s) -%.1fpx -%.1fpx / %.1fpx %.1fpx no-repeat"></div>' % (
+                        size, size, location, x * scaleX, y * scaleY,
+                        sheetWidth * scaleX, sheetHeight * scaleY))
+        # Images live in a subfolder. This splits the path so that
+        # only the relative name is referenced
+        thumbDir = os.path.split(thumbDir)[1]
         # For each score, sort by the colony morphology score
-        scores = [i for i in self.scores.values()]
-        sortedScores = [i for i in sorted( scores, key=lambda info: info[7])]
-        ##### This next chunk makes a 5xn table in the HTML file with
-        ##### alternating images and their scores.
-        n = 0
-        imgLine = []
-        scoreLine = []
+        sortedScores = sorted( self.scores.values(), key=lambda info: info[7])
+        # Split the scores into groups, then the groups into pages.
+        # Each page is (group, page number, first score, last score)
+        groups = []
         for i in range(0, len(sortedScores)):
-            plateID, row, col, x, y, theMin, theMax, score = sortedScores[i]
-            # Font size is set above
-            score = "<font size = '%i'>%s</font>" % (textSize, str(score))
-            imgInfo = "%s: row %s, col %s" % (plateID, str(row), str(col))
-            if doInfo:
-                score = score + "<br>" + imgInfo
-            # This should be a function
-            imName = "_".join([ str(plateID), str(row), str(col) ] ) + ".jpg"
-            # Images live in a subfolder. This splits the path so that
-            # only the relative name is referenced
-            thumbDir = os.path.split(thumbDir)[1]
-            imName = os.path.join(thumbDir, imName)
-            scoreLine.append( score )
-            imgLine.append( img(imName, 300, 300) )
-            n += 1
-            if (( n % numColumns) == 0):
-                t.rows.append( TableRow( imgLine ) )
-                t.rows.append( TableRow( scoreLine) )
-                n = 0
-                imgLine = []
-                scoreLine = []
-        # Append the final row to the table
-        t.rows.append( TableRow( imgLine ) )
-        t.rows.append( TableRow( scoreLine) )
-        # Initialize the connection for the report
-        reportOut = open( reportName, "w")
-        # write the html
-        reportOut.write( str(t) )
-        reportOut.close()
+            group = None
+            if pageBy == "score":
+                group = str(sortedScores[i][7])
+            if not groups or groups[-1][0] != group:
+                groups.append( [group, i, i + 1] )
+            else:
+                groups[-1][2] = i + 1
+        # Keep the scores in the file names readable but safe
+        fileNames = {}
+        for group, first, last in groups:
+            if group is not None:
+                safe = safeName(group)
+                if safe in fileNames.values():
+                    safe = safe + "_%i" % len(fileNames)
+                fileNames[group] = safe
+        pages = []
+        for group, first, last in groups:
+            for pageStart in range(first, last, pageSize):
+                pageNumber = (pageStart - first) // pageSize + 1
+                pages.append( (group, pageNumber, pageStart, min(pageStart + pageSize, last)) )
+        def pageName(reportName, page):
+            group, pageNumber = page[0], page[1]
+            name = os.path.splitext(reportName)[0]
+            if group is not None:
+                name = name + "-score-" + fileNames[group]
+            return name + "-%i.html" % pageNumber
+        def pageTitle(page):
+            group, pageNumber, first, last = page
+            title = "Images %i to %i" % (first + 1, last)
+            if group is not None:
+                title = "Score %s, page %i" % (group or "(none)", pageNumber)
+            return title
+        def startPage(out, title, links):
+            out.write('<html>\n<head><meta charset="utf-8"><title>%s</title></head>\n<body>\n' % title)
+            if links:
+                out.write('<p>%s</p>\n' % " | ".join(links))
+        def endPage(out, links):
+            if links:
+                out.write('\n<p>%s</p>\n' % " | ".join(links))
+            out.write('</body>\n</html>\n')
+        ##### Each page is a 5xn table with alternating images and their scores.
+        t = Table(col_align = ["center" for i in range(0,numColumns)])
+        for p in range(0, len(pages)):
+            page = pages[p]
+            group, pageNumber, first, last = page
+            # Initialize the connections for this page of each report
+            pageOuts = []
+            for reportName, doInfo in reports:
+                links = [link("Index", os.path.basename(reportName))]
+                if p > 0:
+                    links.append( link("Previous", os.path.basename(pageName(reportName, pages[p - 1]))) )
+                if p < len(pages) - 1:
+                    links.append( link("Next", os.path.basename(pageName(reportName, pages[p + 1]))) )
+                pageOut = open( pageName(reportName, page), "w")
+                startPage(pageOut, pageTitle(page), links)
+                pageOut.write( t.head() )
+                pageOuts.append( (pageOut, doInfo, links) )
+            def writeRows(imgLine, scoreLine, infoLine):
+                imgRow = t.row( imgLine )
+                scoreRow = t.row( scoreLine )
+                infoRow = None
+                for pageOut, doInfo, links in pageOuts:
+                    pageOut.write( imgRow )
+                    if doInfo:
+                        if infoRow is None:
+                            infoRow = t.row( infoLine )
+                        pageOut.write( infoRow )
+                    else:
+                        pageOut.write( scoreRow )
+            imgLine = []
+            scoreLine = []
+            infoLine = []
+            for i in range(first, last):
+                plateID, row, col, x, y, theMin, theMax, score = sortedScores[i]
+                # Font size is set above
+                score = "<font size = '%i'>%s</font>" % (textSize, str(score))
+                imgInfo = "%s: row %s, col %s" % (plateID, str(row), str(col))
+                key = (plateID, int(row), int(col))
+                imName = os.path.join(thumbDir, self.thumbnailFormat.name(plateID, row, col))
+                if sprites and key in sprites:
+                    sheetFile, sx, sy, w, h, sheetWidth, sheetHeight = sprites[key]
+                    sheetName = os.path.join(thumbDir, os.path.basename(sheetFile))
+                    thumbnail = sprite(sheetName, sx, sy, w, h, sheetWidth, sheetHeight, thumbSize)
+                else:
+                    thumbnail = img(imName, thumbSize, thumbSize)
+                if self.thumbnailFormat.full:
+                    thumbnail = link(thumbnail, self.thumbnailFormat.fullName(imName))
+                imgLine.append( thumbnail )
+                scoreLine.append( score )
+                infoLine.append( score + "<br>" + imgInfo )
+                if len(imgLine) == numColumns:
+                    writeRows(imgLine, scoreLine, infoLine)
+                    imgLine = []
+                    scoreLine = []
+                    infoLine = []
+            # Append the final row to the table
+            if imgLine:
+                writeRows(imgLine, scoreLine, infoLine)
+            for pageOut, doInfo, links in pageOuts:
+                pageOut.write( t.tail() )
+                endPage(pageOut, links)
+                self.timings.count("reportBytes", pageOut.tell())
+                pageOut.close()
+        # The index links to every page of the report
+        for reportName, doInfo in reports:
+            lines = []
+            for page in pages:
+                group, pageNumber, first, last = page
+                lines.append( "%s (%i images)" % (
+                    link(pageTitle(page), os.path.basename(pageName(reportName, page))),
+                    last - first) )
+            reportOut = open( reportName, "w")
+            startPage(reportOut, "Scores", [])
+            reportOut.write( "<p>%i images</p>\n" % len(sortedScores) )
+            reportOut.write( str(List(lines)) )
+            endPage(reportOut, [])
+            self.timings.count("reportBytes", reportOut.tell())
+            reportOut.close()
 
     def close(self):
+        if self.loader is not None:
+            self.loader.close()
+        self.prefetcher.close()
         self.openImage.close()
-        self.writeReport(self.reportFile, self.thumbDir)
-        self.writeReport(self.reportFile2, self.thumbDir, doInfo=True)
+        if self.journal.exists():
+            try:
+                self.journal.compact([self.scores[wellID] for wellID in self.scored] +
+                                     [info for info in self.otherScores.values()])
+            except ValueError:
+                print("Couldn't write the score file: %s" % sys.exc_info()[1])
+        self.journal.close()
+        self.writeSession()
+        # The report links to the thumbnails, so they
+        # all have to be written before it is
+        self.thumbnails.close()
+        sprites = None
+        if self.sprites != "well":
+            with self.timings.time("sprites"):
+                sprites = self.writeSprites()
+        with self.timings.time("report"):
+            self.writeReports([(self.reportFile, False), (self.reportFile2, True)],
+                              self.thumbDir, sprites=sprites)
         for grid in self.grids.values():
             grid.close()
+        print(self.sourceImages.stats())
+        if self.timings.enabled:
+            self.timings.count("imagesLoaded", self.sourceImages.misses)
+            self.timings.count("imagesEvicted", self.sourceImages.evictions)
+            self.timings.sampleMemory()
+            self.timings.write(self.timingFile)
+
+
+
+
+###########################################################################
+#####                       Begin Batch Export                        #####
+###########################################################################
+
+
+def cpuCount():
+    if haveImageJ:
+        return Runtime.getRuntime().availableProcessors()
+    # Jython doesn't have multiprocessing, but it always has ImageJ here
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def runInThreads(tasks, workers):
+    """
+    Calls each function in tasks on a pool of threads and waits for
+    all of them to finish. If a task raises an error, the tasks that
+    haven't started are skipped and the error is raised again here.
+
+    Arguments:
+    - tasks : list, functions that take no arguments
+    - workers : integer, the number of threads
+    """
+    tasks = [task for task in tasks]
+    errors = []
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                if not tasks or errors:
+                    return
+                task = tasks.pop(0)
+            try:
+                task()
+            except:
+                with lock:
+                    errors.append(sys.exc_info())
+    threads = []
+    for i in range(max(1, min(workers, len(tasks)))):
+        thread = threading.Thread(target=work, name="ccm-worker-%i" % i)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        errorType, error, tb = errors[0]
+        raise error
+
+
+def percentileRange(histogram, low = 0.005, high = 0.995):
+    """
+    Returns the pixel values below which the fractions low
+    and high of the pixels in a histogram fall
+
+    Arguments:
+    - histogram : list, the number of pixels with each value
+    - low, high : float, fractions of the pixels
+    """
+    total = sum(histogram)
+    lowCount = total * low
+    highCount = total * high
+    theMin = None
+    theMax = len(histogram) - 1
+    seen = 0
+    for value in range(len(histogram)):
+        seen = seen + histogram[value]
+        if theMin is None and seen > lowCount:
+            theMin = value
+        if seen >= highCount:
+            theMax = value
+            break
+    if theMin is None:
+        theMin = 0
+    return theMin, max(theMax, theMin + 1)
+
+
+def exportThumbnails(fp, outDir, minVal = 0, maxVal = 255, perPlate = False,
+                     workers = None, perWell = False, sprites = False,
+                     thumbnailFormat = None):
+    """
+    Writes a thumbnail of every cell of every grid without opening
+    any windows, e.g. to make galleries of plates that haven't been
+    scored. The grids are grouped by the image they were aligned on
+    and each image is cropped by one thread.
+
+    Arguments:
+    - fp : list, paths to the grid files, as for GridSet
+    - outDir : string, the directory to write the thumbnails to
+    - minVal, maxVal : integer, the min and max of every thumbnail
+    - perPlate : bool, if True the min and max are set for each image
+      from its histogram instead, see percentileRange
+    - workers : integer, the number of threads. Defaults to the
+      number of processors.
+    - perWell : bool, if True the min and max are set for each cell
+      from its own histogram
+    - sprites : bool, if True the thumbnails of each plate are packed
+      into sprite sheets with an index, sprites.tsv, instead of being
+      written one by one. See SpriteSheet.
+    - thumbnailFormat : ThumbnailFormat, the size and format of the
+      thumbnails. Defaults to ThumbnailFormat().
+
+    Returns the number of thumbnails written and the time it took in
+    seconds.
+    """
+    start = time.time()
+    if workers is None:
+        workers = cpuCount()
+    if thumbnailFormat is None:
+        thumbnailFormat = ThumbnailFormat()
+    try:
+        os.makedirs(outDir)
+    except OSError:
+        pass
+    sourceImages = SourceImageCache()
+    # These are indexed by the path to the source image
+    byImage = {}
+    for i in fp:
+        grid = GridReader(i, sourceImages)
+        byImage.setdefault(sourceImages.key(grid.imagePath), []).append(grid)
+    counts = []
+    allSheets = []
+    def exportImage(grids):
+        theMin, theMax = minVal, maxVal
+        if perPlate:
+            histogram = sourceImages.histogram(grids[0].imagePath)
+            theMin, theMax = percentileRange(histogram)
+        n = 0
+        for grid in grids:
+            if sprites:
+                keys = [(coord[0], int(coord[1]), int(coord[2])) for coord in grid.getCoords()]
+                sheets = planSpriteSheets(outDir, [(grid.getPlateID(), keys)], int(grid.width),
+                                          thumbnailFormat=thumbnailFormat)
+                sheetOf = {}
+                for sheet in sheets:
+                    for key in sheet.keys:
+                        sheetOf[key] = sheet
+            for coord, processor in grid.cropAll():
+                plateID, row, col, x, y = coord
+                if perWell:
+                    theMin, theMax = percentileRange(processor.getHistogram())
+                processor.setMinAndMax(theMin, theMax)
+                imName = os.path.join(outDir, thumbnailFormat.name(plateID, row, col))
+                if sprites:
+                    # Sheets are saved as soon as they're full, which
+                    # is in order since the cells are cropped top down
+                    key = (plateID, int(row), int(col))
+                    if sheetOf[key].paste(key, thumbnailFormat.shrink(processor)):
+                        sheetOf[key].save()
+                    if thumbnailFormat.full:
+                        thumbnailFormat.writeFull(processor, imName)
+                else:
+                    thumbnailFormat.write(processor, imName)
+                n = n + 1
+            if sprites:
+                # Sheets with cells outside the image are never full
+                for sheet in sheets:
+                    sheet.save()
+                allSheets.extend(sheets)
+            grid.close()
+        counts.append(n)
+    tasks = [lambda grids=grids: exportImage(grids) for grids in byImage.values()]
+    runInThreads(tasks, workers)
+    if sprites:
+        allSheets.sort(key=lambda sheet: sheet.fn)
+        writeSpriteIndex(os.path.join(outDir, "sprites.tsv"), allSheets)
+    return sum(counts), time.time() - start
+
+
+def exportCommand(argv):
+    parser = argparse.ArgumentParser(
+        prog="export",
+        description="Write a thumbnail of every cell of the grids without a display")
+    parser.add_argument("outDir", help="directory to write the thumbnails to")
+    parser.add_argument("grids", nargs="+", help="grid files")
+    parser.add_argument("--min", type=int, default=0, help="min of every thumbnail")
+    parser.add_argument("--max", type=int, default=255, help="max of every thumbnail")
+    parser.add_argument("--per-plate", action="store_true",
+                        help="set the min and max of each image from its histogram")
+    parser.add_argument("--per-well", action="store_true",
+                        help="set the min and max of each cell from its histogram")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of threads (default: number of processors)")
+    parser.add_argument("--sprites", action="store_true",
+                        help="pack the thumbnails of each plate into sprite sheets")
+    parser.add_argument("--size", type=int, default=300,
+                        help="most width and height of a thumbnail, 0 for the size of the cell")
+    parser.add_argument("--format", default="jpeg", choices=["jpeg", "png"],
+                        help="thumbnail format, png is lossless")
+    parser.add_argument("--quality", type=int, default=85, help="JPEG quality (0-100)")
+    parser.add_argument("--full", action="store_true",
+                        help="also write each cell at full size to outDir/full")
+    parser.add_argument("--backend", default=None, choices=sorted(backends.keys()),
+                        help="imaging backend (default: imagej in Fiji, numpy otherwise)")
+    args = parser.parse_args(argv)
+    if args.backend is not None:
+        useBackend(args.backend)
+    n, seconds = exportThumbnails(args.grids, args.outDir, args.min, args.max,
+                                  args.per_plate, args.workers, args.per_well,
+                                  args.sprites, ThumbnailFormat(args.size, args.format,
+                                                                args.quality, args.full))
+    print("Wrote %i thumbnails in %.1f s (%.1f wells/sec)" % (n, seconds, n / max(seconds, 1e-6)))
+
+
+
+
+###########################################################################
+#####                       Begin Colony Features                     #####
+###########################################################################
+
+# The measurements made by colonyFeatures, in order
+featureNames = ["area", "perimeter", "perimeterRatio", "mean", "texture",
+                "edgeDensity", "radial1", "radial2", "radial3", "radial4"]
+
+# The columns of a feature table. image and imageTime are the source
+# image of each well and its modification time, which tell whether
+# the features of a well have to be measured again.
+featureHeader = ["plate", "row", "col", "x", "y", "image", "imageTime"] + featureNames + ["score"]
+
+
+def colonyFeatures(processor):
+    """
+    Measures the colony in a cropped cell. Each step is an ImageJ
+    operation on the whole cell, so no pixel is looked at in python.
+
+    The colony is the part of the cell on the same side of the
+    automatic threshold as the center of the cell. The features are:
+    - area : the number of pixels in the colony
+    - perimeter : the number of pixels on the outline of the colony
+    - perimeterRatio : perimeter / area, which grows as the colony
+      gets more wrinkled or irregular
+    - mean, texture : the mean and standard deviation of the pixels
+      in the colony
+    - edgeDensity : the mean of the edges (Sobel) of the cell, on a
+      0 to 1 scale
+    - radial1 to radial4 : the mean of the pixels in 4 rings of equal
+      width around the center of the colony, from the inside out
+
+    Returns a list of the features, in the order of featureNames
+    """
+    w = processor.getWidth()
+    h = processor.getHeight()
+    gray = processor.convertToByte(True)
+    mask = gray.duplicate()
+    mask.threshold(gray.getAutoThreshold())
+    if mask.get(w // 2, h // 2) == 0:
+        mask.invert()
+    area = mask.getHistogram()[255]
+    # The outline is what's left of the colony once it is eroded
+    # by a pixel, which is done by shifting it in each direction
+    eroded = mask.duplicate()
+    for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+        eroded.copyBits(mask, dx, dy, Blitter.AND)
+    outline = mask.duplicate()
+    outline.copyBits(eroded, 0, 0, Blitter.DIFFERENCE)
+    perimeter = outline.getHistogram()[255]
+    mean, texture = 0.0, 0.0
+    cx, cy = w / 2.0, h / 2.0
+    if area > 0:
+        processor.setRoi(0, 0, w, h)
+        processor.setMask(mask)
+        stats = ImageStatistics.getStatistics(processor,
+            Measurements.MEAN | Measurements.STD_DEV | Measurements.CENTROID, None)
+        mean, texture = stats.mean, stats.stdDev
+        cx, cy = stats.xCentroid, stats.yCentroid
+        processor.resetRoi()
+    edges = gray.duplicate()
+    edges.findEdges()
+    edgeDensity = ImageStatistics.getStatistics(edges, Measurements.MEAN, None).mean / 255.0
+    # Each ring is the difference between two discs
+    radial = []
+    lastSum, lastCount = 0.0, 0
+    step = min(w, h) / 2.0 / 4
+    for ring in range(1, 5):
+        r = step * ring
+        processor.setRoi(OvalRoi(cx - r, cy - r, 2 * r, 2 * r))
+        stats = ImageStatistics.getStatistics(processor, Measurements.MEAN, None)
+        total = stats.mean * stats.pixelCount
+        count = stats.pixelCount - lastCount
+        if count > 0:
+            radial.append( (total - lastSum) / count )
+        else:
+            radial.append(0.0)
+        lastSum, lastCount = total, stats.pixelCount
+    processor.resetRoi()
+    perimeterRatio = 0.0
+    if area > 0:
+        perimeterRatio = perimeter / float(area)
+    return [area, perimeter, perimeterRatio, mean, texture, edgeDensity] + radial
+
+
+def readFeatureTable(featureFile):
+    """
+    Returns the rows of a feature table indexed by (plate, row, col),
+    or an empty dictionary if there isn't one
+    """
+    rows = {}
+    if os.path.isfile(featureFile):
+        inFile = open(featureFile, "r")
+        for row in csv.reader(inFile, delimiter=","):
+            if len(row) == len(featureHeader) and row != featureHeader:
+                rows[ (row[0], row[1], row[2]) ] = row
+        inFile.close()
+    return rows
+
+
+def extractFeatures(fp, featureFile, scoreFile = None, workers = None):
+    """
+    Measures the colony in every cell of every grid (see
+    colonyFeatures) and writes a feature table with a row for each
+    well, joined to its score.
+
+    The features are only measured again for wells whose source image
+    has changed since the table was written or whose position on the
+    grid has moved. The grids are grouped by the image they were
+    aligned on and each image is cropped in one sweep by one thread.
+
+    Arguments:
+    - fp : list, paths to the grid files, as for GridSet
+    - featureFile : string, the CSV file to write the table to
+    - scoreFile : string, a score file written by GridSet. The last
+      score of each well goes in the score column. If not specified
+      the score column is left empty.
+    - workers : integer, the number of threads. Defaults to the
+      number of processors.
+
+    Returns the number of wells that were measured, the number whose
+    features were kept from the old table and the time it took in
+    seconds.
+    """
+    start = time.time()
+    if workers is None:
+        workers = cpuCount()
+    previous = readFeatureTable(featureFile)
+    sourceImages = SourceImageCache()
+    # These are indexed by the path to the source image
+    byImage = {}
+    for i in fp:
+        grid = GridReader(i, sourceImages)
+        byImage.setdefault(sourceImages.key(grid.imagePath), []).append(grid)
+    # Rows of the new table, without the score, indexed by (plate, row, col)
+    rows = {}
+    counts = []
+    lock = threading.Lock()
+    def measureImage(grids):
+        imageTime = repr(os.path.getmtime(grids[0].imagePath))
+        measured = 0
+        for grid in grids:
+            image = os.path.basename(grid.imagePath)
+            toMeasure = []
+            for coord in grid.getCoords():
+                plateID, row, col, x, y = coord
+                key = (plateID, str(row), str(col))
+                old = previous.get(key)
+                if old is not None and old[3:7] == [x, y, image, imageTime]:
+                    with lock:
+                        rows[key] = old[:-1]
+                else:
+                    toMeasure.append(coord)
+            for coord, processor in grid.cropAll(toMeasure):
+                plateID, row, col, x, y = coord
+                features = colonyFeatures(processor)
+                with lock:
+                    rows[ (plateID, str(row), str(col)) ] = [plateID, row, col, x, y,
+                                                             image, imageTime] + features
+                measured = measured + 1
+            grid.close()
+        counts.append(measured)
+    tasks = [lambda grids=grids: measureImage(grids) for grids in byImage.values()]
+    runInThreads(tasks, workers)
+    # Join the scores, the last one for a well wins
+    scores = {}
+    if scoreFile is not None:
+        for plateID, row, col, x, y, theMin, theMax, score in ScoreJournal(scoreFile).replay():
+            scores[ (plateID, row, col) ] = score
+    out = open(featureFile, "w")
+    writer = csv.writer(out, delimiter=",")
+    writer.writerow(featureHeader)
+    for key in sorted(rows.keys(), key=lambda key: (key[0], int(key[1]), int(key[2]))):
+        writer.writerow(rows[key] + [scores.get(key, "")])
+    out.close()
+    measured = sum(counts)
+    return measured, len(rows) - measured, time.time() - start
+
+
+def featuresCommand(argv):
+    parser = argparse.ArgumentParser(
+        prog="features",
+        description="Measure the colony in every cell of the grids")
+    parser.add_argument("featureFile", help="CSV file to write the features to")
+    parser.add_argument("grids", nargs="+", help="grid files")
+    parser.add_argument("--scores", default=None,
+                        help="score file to take the score of each well from")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of threads (default: number of processors)")
+    args = parser.parse_args(argv)
+    requireImageJ("Measuring colonies")
+    measured, kept, seconds = extractFeatures(args.grids, args.featureFile,
+                                              args.scores, args.workers)
+    print("Measured %i wells and kept %i in %.1f s" % (measured, kept, seconds))
+
+
+
+
+###########################################################################
+#####                       Begin Grid Fitting                        #####
+###########################################################################
+
+
+def smoothProfile(profile, size):
+    """
+    Returns the moving average of a profile over size points
+    """
+    sums = [0.0]
+    for value in profile:
+        sums.append(sums[-1] + value)
+    half = size // 2
+    smooth = []
+    for i in range(len(profile)):
+        lo = max(0, i - half)
+        hi = min(len(profile), i + size - half)
+        smooth.append( (sums[hi] - sums[lo]) / (hi - lo) )
+    return smooth
+
+
+def fitLattice(profile, n, width):
+    """
+    Finds n evenly spaced wells along a projection profile of the edges
+    of a plate. Wells are where the edges of the colonies are, and the
+    gaps half way between them are where there are no edges. The
+    spacing and position that give the biggest difference between the
+    two are found with a coarse search that is then refined.
+
+    Arguments:
+    - profile : list, the mean of the edges in each column (or row)
+    - n : integer, the number of wells along the profile
+    - width : integer, the width of a well
+
+    Returns (centers, contrast) where centers are the positions of the
+    centers of the wells and contrast is how much stronger the profile
+    is at the wells than between them, from 0 (no better than chance)
+    to 1 (nothing between the wells)
+    """
+    size = len(profile)
+    # Smoothing twice peaks at the middle of each colony
+    # instead of leaving a plateau across it
+    smooth = smoothProfile(profile, max(1, width // 2))
+    smooth = smoothProfile(smooth, max(1, width // 2))
+    def objective(first, pitch):
+        wells = [smooth[ int(first + k * pitch) ] for k in range(n)]
+        if n > 1:
+            gaps = [smooth[ int(first + k * pitch + pitch / 2.0) ] for k in range(n - 1)]
+        else:
+            gaps = smooth
+        wellMean = sum(wells) / len(wells)
+        return wellMean - sum(gaps) / len(gaps), wellMean
+    def search(firsts, pitches):
+        best = None
+        for pitch in pitches:
+            for first in firsts:
+                if first < 0 or first + (n - 1) * pitch > size - 1:
+                    continue
+                score, wellMean = objective(first, pitch)
+                if best is None or score > best[0]:
+                    best = (score, wellMean, first, pitch)
+        return best
+    if n > 1:
+        maxPitch = (size - 1) / float(n - 1)
+        minPitch = min(maxPitch, max(1, width // 2))
+    else:
+        minPitch = maxPitch = 1
+    # Search every step points, then every point around the best
+    step = max(1, width // 40)
+    best = search(range(0, size, step), range(int(minPitch), int(maxPitch) + 1, step))
+    if best is None:
+        raise ValueError("%i wells of width %i don't fit in %i pixels" % (n, width, size))
+    score, wellMean, first, pitch = best
+    best = search(range(first - step, first + step + 1),
+                  range(pitch - step, pitch + step + 1)) or best
+    score, wellMean, first, pitch = best
+    contrast = 0.0
+    if wellMean > 0:
+        contrast = max(0.0, score / wellMean)
+    return [first + k * pitch for k in range(n)], contrast
+
+
+def fitGrid(imgPath, rows, columns, width):
+    """
+    Fits a grid of rows x columns wells to the colonies of a plate
+    image from projection profiles of its edges, so plates don't have
+    to be aligned by hand in Microarray Profile. The wells must be
+    in straight rows and columns that are lined up with the image.
+
+    Returns (coords, quality) where coords are the (x, y) corners of
+    the wells in the order of a grid file, and quality is the lower
+    contrast of the row and column fits (see fitLattice). Plates with
+    a low quality should be checked by hand.
+    """
+    image = ImagePlus(imgPath)
+    if image.getProcessor() is None:
+        raise ValueError("Couldn't open %s" % imgPath)
+    edges = image.getProcessor().convertToByte(True)
+    edges.findEdges()
+    edgeImage = ImagePlus("edges", edges)
+    edgeImage.setRoi( Roi(0, 0, edges.getWidth(), edges.getHeight()) )
+    # Column profile, then row profile
+    xProfile = [i for i in ProfilePlot(edgeImage).getProfile()]
+    yProfile = [i for i in ProfilePlot(edgeImage, True).getProfile()]
+    image.close()
+    xCenters, xContrast = fitLattice(xProfile, columns, width)
+    yCenters, yContrast = fitLattice(yProfile, rows, width)
+    coords = []
+    for y in yCenters:
+        for x in xCenters:
+            coords.append( (int(round(x - width / 2.0)), int(round(y - width / 2.0))) )
+    return coords, min(xContrast, yContrast)
+
+
+def writeGrid(fp, rows, columns, width, coords):
+    """
+    Writes a grid file that GridReader can read, in the format of
+    the Microarray Profile plugin
+    """
+    out = open(fp, "w")
+    out.write("%i\t%i\t%i\n" % (rows, columns, width))
+    for x, y in coords:
+        out.write("%i\t%i\n" % (x, y))
+    out.close()
+
+
+def fitGridCommand(argv):
+    parser = argparse.ArgumentParser(
+        prog="fitgrid",
+        description="Fit a grid to each plate image and write it next to the image")
+    parser.add_argument("rows", type=int, help="rows of wells")
+    parser.add_argument("columns", type=int, help="columns of wells")
+    parser.add_argument("width", type=int, help="width of a well in pixels")
+    parser.add_argument("images", nargs="+", help="plate images (.tif)")
+    parser.add_argument("--name", default="fit",
+                        help="grid name, the grid of image.tif is written to image_name")
+    parser.add_argument("--min-quality", type=float, default=0.1,
+                        help="grids with a lower quality are flagged for checking")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of threads (default: number of processors)")
+    args = parser.parse_args(argv)
+    requireImageJ("Fitting grids")
+    if "_" in args.name:
+        raise ValueError("The grid name can't have an underscore")
+    if args.workers is None:
+        args.workers = cpuCount()
+    lock = threading.Lock()
+    def fitImage(imgPath):
+        imageID = os.path.splitext(os.path.basename(imgPath))[0]
+        if "_" in imageID:
+            raise ValueError("The image name can't have an underscore: %s" % imgPath)
+        fp = os.path.join(os.path.dirname(imgPath), imageID + "_" + args.name)
+        coords, quality = fitGrid(imgPath, args.rows, args.columns, args.width)
+        writeGrid(fp, args.rows, args.columns, args.width, coords)
+        flag = ""
+        if quality < args.min_quality:
+            flag = "  <- check by hand"
+        with lock:
+            print("%s\tquality %.2f%s" % (fp, quality, flag))
+    tasks = [lambda imgPath=imgPath: fitImage(imgPath) for imgPath in args.images]
+    runInThreads(tasks, args.workers)
+
+
+
+
+###########################################################################
+#####                       Begin Benchmark                           #####
+###########################################################################
+
+# The rows and columns of the plate formats the benchmark can make,
+# indexed by the number of wells
+plateFormats = {96 : (8, 12), 384 : (16, 24), 1536 : (32, 48)}
+
+
+def writeTiff(fn, width, height, bitsPerSample, pixels, rowsPerStrip = 64):
+    """
+    Writes an uncompressed grayscale TIFF
+
+    Arguments:
+    - fn : string, the file to write
+    - width, height : integer, the size of the image
+    - bitsPerSample : integer, 8 or 16
+    - pixels : array, width * height pixels a row at a time, of
+      type "B" for 8 bit images or "H" for 16 bit images
+    """
+    if sys.byteorder == "big" and bitsPerSample == 16:
+        pixels = array("H", pixels)
+        pixels.byteswap()
+    # tostring was renamed tobytes in python 3
+    if hasattr(pixels, "tobytes"):
+        data = pixels.tobytes()
+    else:
+        data = pixels.tostring()
+    stripBytes = rowsPerStrip * width * (bitsPerSample // 8)
+    offsets = []
+    counts = []
+    for start in range(0, len(data), stripBytes):
+        offsets.append(8 + start)
+        counts.append(min(stripBytes, len(data) - start))
+    tags = [(256, 4, [width]), (257, 4, [height]), (258, 3, [bitsPerSample]),
+            (259, 3, [1]), (262, 3, [1]), (273, 4, offsets), (277, 3, [1]),
+            (278, 4, [rowsPerStrip]), (279, 4, counts)]
+    ifdOffset = 8 + len(data)
+    # Values that don't fit in a tag go after the tags
+    extraOffset = ifdOffset + 2 + 12 * len(tags) + 4
+    entries = []
+    extra = []
+    for tag, fieldType, values in tags:
+        code = {3 : "H", 4 : "I"}[fieldType]
+        packed = struct.pack("<" + code * len(values), *values)
+        if len(packed) <= 4:
+            entries.append(struct.pack("<HHI", tag, fieldType, len(values)) + packed.ljust(4, b"\0"))
+        else:
+            entries.append(struct.pack("<HHII", tag, fieldType, len(values), extraOffset))
+            extra.append(packed)
+            extraOffset = extraOffset + len(packed)
+    out = open(fn, "wb")
+    out.write(b"II" + struct.pack("<HI", 42, ifdOffset))
+    out.write(data)
+    out.write(struct.pack("<H", len(tags)))
+    out.write(b"".join(entries))
+    out.write(struct.pack("<I", 0))
+    out.write(b"".join(extra))
+    out.close()
+
+
+def synthesizePlate(directory, name, wells, bitsPerSample, pitch, rng):
+    """
+    Writes an image of a plate with a colony in every well, and a grid
+    file for it in the format of the Microarray Profile plugin. The
+    colonies vary in size, brightness and position.
+
+    Arguments:
+    - directory : string, where to write the image and grid
+    - name : string, the name of the image. It can't have an
+      underscore in it.
+    - wells : integer, a key of plateFormats
+    - bitsPerSample : integer, 8 or 16
+    - pitch : integer, the distance between wells in pixels
+    - rng : Random
+
+    Returns the path to the grid file
+    """
+    rows, columns = plateFormats[wells]
+    margin = pitch // 2
+    width = columns * pitch + 2 * margin
+    height = rows * pitch + 2 * margin
+    maxValue = (1 << bitsPerSample) - 1
+    code = {8 : "B", 16 : "H"}[bitsPerSample]
+    pixels = array(code, [maxValue // 5]) * (width * height)
+    # The cells on the grid are a little smaller than the wells
+    cell = pitch - 2
+    gridOut = open(os.path.join(directory, name + "_grid"), "w")
+    gridOut.write("%i\t%i\t%i\n" % (rows, columns, cell))
+    for row in range(rows):
+        for col in range(columns):
+            left = margin + col * pitch
+            top = margin + row * pitch
+            gridOut.write("%i\t%i\n" % (left + 1, top + 1))
+            radius = rng.randint(pitch // 5, pitch * 3 // 10)
+            cx = left + pitch // 2 + rng.randint(-pitch // 10, pitch // 10)
+            cy = top + pitch // 2 + rng.randint(-pitch // 10, pitch // 10)
+            value = rng.randint(maxValue // 2, maxValue)
+            for dy in range(-radius, radius + 1):
+                half = int((radius * radius - dy * dy) ** 0.5)
+                start = (cy + dy) * width + cx - half
+                pixels[start:start + 2 * half + 1] = array(code, [value]) * (2 * half + 1)
+    gridOut.close()
+    writeTiff(os.path.join(directory, name + ".tif"), width, height, bitsPerSample, pixels)
+    return os.path.join(directory, name + "_grid")
+
+
+class BenchmarkGridSet(GridSet):
+    """
+    A GridSet that doesn't display anything
+    """
+    def openCell(self, n):
+        return HeadlessImage( GridSet.openCell(self, n).getProcessor() )
+
+
+def runBenchmark(outDir, wells, plates, bitsPerSample, pitch = 40,
+                 scoreWells = None, seed = 1):
+    """
+    Makes a set of synthetic plates and scores them without a display,
+    timing each step (see Timings): reading grid files (parse), reading
+    whole images (decode), cropping one cell (crop) and a whole plate
+    (cropAll, per plate), opening and showing cells, writing thumbnails,
+    saving scores and writing the report.
+
+    Arguments:
+    - outDir : string, the plates, scores and reports are written to
+      a folder in it named after the settings
+    - wells : integer, the wells on each plate, see plateFormats
+    - plates : integer, the number of plates
+    - bitsPerSample : integer, 8 or 16
+    - pitch : integer, the distance between wells in pixels
+    - scoreWells : integer, the number of wells to score. Defaults to
+      every well.
+    - seed : integer, the seed for the plates and the scores
+
+    Returns a dictionary with the settings, the time it took and the
+    summary of the timings
+    """
+    rng = Random(seed)
+    directory = os.path.join(outDir, "bench-%iwells-%iplates-%ibit" % (wells, plates, bitsPerSample))
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass
+    grids = []
+    for plate in range(plates):
+        grids.append( synthesizePlate(directory, "plate%04i" % plate, wells,
+                                      bitsPerSample, pitch, rng) )
+    scoreFile = os.path.join(directory, "scores.csv")
+    # Start from scratch every time
+    for fn in [scoreFile, scoreFile + ".journal", os.path.splitext(scoreFile)[0] + ".session"]:
+        if os.path.isfile(fn):
+            os.remove(fn)
+    start = time.time()
+    gridSet = BenchmarkGridSet(grids, scoreFile, os.path.join(directory, "scores_cropped"),
+                               seed=seed, timing=True)
+    timings = gridSet.timings
+    for grid in gridSet.grids.values():
+        with timings.time("decode"):
+            imaging.openImage(grid.imagePath).close()
+        with timings.time("cropAll"):
+            for coord, processor in grid.cropAll():
+                pass
+    if scoreWells is None:
+        scoreWells = len(gridSet.gridCoords)
+    scoreWells = min(scoreWells, len(gridSet.gridCoords))
+    for i in range(scoreWells):
+        gridSet.openNext()
+        gridSet.writeScore( rng.choice(["0", "1", "2", "3"]) )
+    gridSet.close()
+    seconds = time.time() - start
+    return {
+        "wells" : wells,
+        "plates" : plates,
+        "bitsPerSample" : bitsPerSample,
+        "pitch" : pitch,
+        "scored" : scoreWells,
+        "seconds" : seconds,
+        "wellsPerSecond" : scoreWells / max(seconds, 1e-6),
+        "timings" : timings.summary(),
+        }
+
+
+def benchmarkCommand(argv):
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Time scoring synthetic plates without a display")
+    parser.add_argument("outDir", help="directory to write the plates and results to")
+    parser.add_argument("--wells", type=int, nargs="+", default=[96],
+                        choices=sorted(plateFormats.keys()), help="wells per plate")
+    parser.add_argument("--plates", type=int, nargs="+", default=[1],
+                        help="number of plates")
+    parser.add_argument("--bits", type=int, nargs="+", default=[8], choices=[8, 16],
+                        help="bits per pixel")
+    parser.add_argument("--pitch", type=int, default=40, help="pixels between wells")
+    parser.add_argument("--score", type=int, default=None,
+                        help="wells to score in each run (default: all)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", default=None, choices=sorted(backends.keys()),
+                        help="imaging backend (default: imagej in Fiji, numpy otherwise)")
+    parser.add_argument("--results", default=None,
+                        help="JSON file for the results (default: outDir/benchmark.json)")
+    args = parser.parse_args(argv)
+    if args.backend is not None:
+        useBackend(args.backend)
+    if args.results is None:
+        args.results = os.path.join(args.outDir, "benchmark.json")
+    runs = []
+    # Every combination of the settings is run
+    for wells in args.wells:
+        for plates in args.plates:
+            for bits in args.bits:
+                run = runBenchmark(args.outDir, wells, plates, bits, args.pitch,
+                                   args.score, args.seed)
+                print("%i wells x %i plates, %i bit: %.1f s (%.1f wells/sec)" % (
+                    wells, plates, bits, run["seconds"], run["wellsPerSecond"]))
+                runs.append(run)
+    results = {
+        "started" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : sys.version,
+        "backend" : imaging.name,
+        "runs" : runs,
+        }
+    if haveImageJ:
+        results["java"] = System.getProperty("java.version")
+        results["imagej"] = IJ.getVersion()
+    out = open(args.results, "w")
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write("\n")
+    out.close()
+    print("Wrote %s" % args.results)
+
+
+
+
+###########################################################################
+#####                       Begin Score Analytics                     #####
+###########################################################################
+
+# Score files from any number of scorers are joined on the well without
+# holding them in memory. Each file is cut into runs that are sorted by
+# well and written to temporary files, and the runs are merged so that
+# every score of a well comes out together. Only the tallies of
+# AgreementStats are kept in memory.
+
+
+def scorerNames(scoreFiles):
+    """
+    Returns (scorer, score file) for each score file. A score file can
+    be given as "name=path" to name its scorer. Otherwise the scorer is
+    named after the shortest end of the path, without the extension,
+    that no other file has, e.g. "alice/scores" and "bob/scores" for
+    alice/scores.csv and bob/scores.csv. Raises ValueError if two files
+    still get the same name.
+    """
+    named = []
+    for entry in scoreFiles:
+        name, sep, path = entry.partition("=")
+        if sep and name and not os.path.isfile(entry):
+            named.append((name, path))
+        else:
+            named.append((None, entry))
+    parts = [os.path.splitext(os.path.abspath(path))[0].replace("\\", "/").split("/")
+             for name, path in named]
+    # The number of parts of the path in each name
+    depths = [1] * len(named)
+    while True:
+        names = [named[i][0] or "/".join(parts[i][-depths[i]:]) for i in range(len(named))]
+        grown = False
+        for i in range(len(named)):
+            if named[i][0] is None and names.count(names[i]) > 1 and depths[i] < len(parts[i]):
+                depths[i] = depths[i] + 1
+                grown = True
+        if not grown:
+            break
+    for i in range(len(named)):
+        for j in range(i):
+            if names[i] == names[j]:
+                raise ValueError("%s and %s are both scorer %s, give them different names with name=path"
+                                 % (named[j][1], named[i][1], names[i]))
+    return [(names[i], named[i][1]) for i in range(len(named))]
+
+
+def readScoreRecords(scoreFile, positions, fileScorer):
+    """
+    Yields (plate, row, col, scorer, position, score) for each score in
+    a score file. The scorer is taken from the scorer column that
+    dbexport writes, or else is fileScorer.
+
+    Arguments:
+    - positions : dict, the number of scores of each scorer read so
+      far. It's updated as the file is read, so position is the
+      order each scorer gave their scores in, across all files.
+    """
+    inFile = open(scoreFile, "r")
+    for row in csv.reader(inFile, delimiter=","):
+        if len(row) == len(ScoreJournal.header):
+            scorer = fileScorer
+        elif len(row) == len(ScoreJournal.header) + 1:
+            scorer = row[-1]
+        else:
+            continue
+        try:
+            well = (row[0], int(row[1]), int(row[2]))
+        except ValueError:
+            # The header
+            continue
+        position = positions.get(scorer, 0)
+        positions[scorer] = position + 1
+        yield well + (scorer, position, row[7])
+    inFile.close()
+
+
+def readRun(fn):
+    """
+    Yields the records of a run written by ScoreMerger
+    """
+    inFile = open(fn, "r")
+    for plateID, row, col, scorer, position, score in csv.reader(inFile, delimiter=","):
+        yield (plateID, int(row), int(col), scorer, int(position), score)
+    inFile.close()
+
+
+class ScoreMerger:
+    """
+    Joins the scores of many score files on (plate, row, col). sort()
+    reads the files once and writes sorted runs of at most runRows
+    scores, then wells() merges the runs.
+
+    Attributes:
+    - scoreFiles : list, the score files, named as for scorerNames
+    - runRows : integer, the most scores sorted in memory at once
+    - fanIn : integer, the most runs merged at once. Runs are merged
+      in rounds until there are this few, so there are never more
+      files open than this.
+    - tmpDir : string, the folder for the runs (default: the system's)
+    - counts : dict, the number of scores of each scorer, set by sort()
+    """
+
+    def __init__(self, scoreFiles, runRows = 100000, fanIn = 64, tmpDir = None):
+        self.scoreFiles = scoreFiles
+        self.runRows = runRows
+        self.fanIn = fanIn
+        self.tmpDir = tmpDir
+        self.counts = {}
+        self.runs = []
+
+    def writeRun(self, records):
+        fd, fn = tempfile.mkstemp(prefix="ccm-run-", suffix=".csv", dir=self.tmpDir)
+        out = os.fdopen(fd, "w")
+        writer = csv.writer(out, delimiter=",")
+        for record in records:
+            writer.writerow(record)
+        out.close()
+        return fn
+
+    def sort(self):
+        records = []
+        for scorer, scoreFile in scorerNames(self.scoreFiles):
+            for record in readScoreRecords(scoreFile, self.counts, scorer):
+                records.append(record)
+                if len(records) >= self.runRows:
+                    records.sort()
+                    self.runs.append( self.writeRun(records) )
+                    records = []
+        if records:
+            records.sort()
+            self.runs.append( self.writeRun(records) )
+        while len(self.runs) > self.fanIn:
+            merged = []
+            for i in range(0, len(self.runs), self.fanIn):
+                group = self.runs[i:i + self.fanIn]
+                merged.append( self.writeRun(heapq.merge(*[readRun(fn) for fn in group])) )
+                for fn in group:
+                    os.remove(fn)
+            self.runs = merged
+
+    def wells(self):
+        """
+        Yields ((plate, row, col), scores) for each well in order, where
+        scores is a dictionary of (position, score) by scorer. If a
+        scorer scored a well more than once their last score is kept.
+        The runs are removed once they've been read.
+        """
+        try:
+            current = None
+            scores = {}
+            for plateID, row, col, scorer, position, score in heapq.merge(*[readRun(fn) for fn in self.runs]):
+                well = (plateID, row, col)
+                if well != current:
+                    if current is not None:
+                        yield current, scores
+                    current = well
+                    scores = {}
+                # The scores of a scorer come out in the order they
+                # were given, so this keeps the last one
+                scores[scorer] = (position, score)
+            if current is not None:
+                yield current, scores
+        finally:
+            self.close()
+
+    def close(self):
+        for fn in self.runs:
+            if os.path.isfile(fn):
+                os.remove(fn)
+        self.runs = []
+
+
+def scoreOrder(score):
+    """
+    Sort key that puts numeric scores in numeric order before the rest
+    """
+    try:
+        return (0, float(score), score)
+    except ValueError:
+        return (1, 0.0, score)
+
+
+def consensusScore(scores):
+    """
+    Returns the most common of scores and the fraction of them it is.
+    The consensus is None when no score or a tie is the most common.
+    """
+    tally = {}
+    for score in scores:
+        tally[score] = tally.get(score, 0) + 1
+    if not tally:
+        return None, 0.0
+    most = max(tally.values())
+    winners = [score for score in tally if tally[score] == most]
+    fraction = most / float(len(scores))
+    if len(winners) > 1:
+        return None, fraction
+    return winners[0], fraction
+
+
+def cohensKappa(confusion):
+    """
+    Returns Cohen's kappa of a confusion matrix, or None if it isn't
+    defined (no wells, or both scorers only ever gave one score)
+
+    Arguments:
+    - confusion : dict, the number of wells of each (score of the
+      first scorer, score of the second) pair
+    """
+    total = float(sum(confusion.values()))
+    if not total:
+        return None
+    firstTotals = {}
+    secondTotals = {}
+    agreed = 0
+    for (first, second), n in confusion.items():
+        firstTotals[first] = firstTotals.get(first, 0) + n
+        secondTotals[second] = secondTotals.get(second, 0) + n
+        if first == second:
+            agreed = agreed + n
+    observed = agreed / total
+    expected = sum([n * secondTotals.get(score, 0) for score, n in firstTotals.items()]) / (total * total)
+    if expected == 1:
+        return None
+    return (observed - expected) / (1 - expected)
+
+
+class AgreementStats:
+    """
+    Tallies how well scorers agree, one well at a time, so any number
+    of wells can be added without keeping them
+
+    Each scorer is compared to the consensus of the other scorers of a
+    well, so their own score doesn't count towards it. Drift is that
+    agreement and the mean score over the order each scorer gave their
+    scores in, cut into driftBins bins.
+
+    Fleiss' kappa uses every well with at least two scores. Wells may
+    have different numbers of scores, so it's the form of Fleiss' kappa
+    where each well's agreement is weighted the same.
+
+    Attributes:
+    - counts : dict, the number of scores of each scorer
+    - driftBins : integer, the number of bins of each scorer's scores
+    - scorers : list, the scorers in order
+    - scores : dict, how many times each score was given
+    - pairs : dict, the confusion matrix of each (scorer, scorer) pair,
+      as in cohensKappa
+    - byScorer, drift : dict, [wells, compared, agreed, total, numeric]
+      of each scorer and each (scorer, bin), where compared wells have
+      a consensus of the other scorers, and total is the sum of the
+      numeric scores
+    - raters : dict, the number of wells with each number of scores
+    """
+
+    def __init__(self, counts, driftBins = 10):
+        self.counts = counts
+        self.driftBins = driftBins
+        self.scorers = sorted(counts.keys())
+        self.scores = {}
+        self.pairs = {}
+        self.byScorer = {}
+        self.drift = {}
+        self.raters = {}
+        self.consensusWells = 0
+        self.fleissSum = 0.0
+        self.fleissWells = 0
+        self.fleissScores = {}
+
+    def add(self, scores):
+        """
+        Tallies the scores of a well and returns its consensus and the
+        fraction of the scores that agree with it (see consensusScore)
+
+        Arguments:
+        - scores : dict, (position, score) by scorer, as from
+          ScoreMerger.wells()
+        """
+        given = [score for position, score in scores.values()]
+        n = len(given)
+        self.raters[n] = self.raters.get(n, 0) + 1
+        for score in given:
+            self.scores[score] = self.scores.get(score, 0) + 1
+        consensus, fraction = consensusScore(given)
+        if consensus is not None and n > 1:
+            self.consensusWells = self.consensusWells + 1
+        # Each scorer against the others
+        for scorer, (position, score) in scores.items():
+            others = [other[1] for name, other in scores.items() if name != scorer]
+            othersConsensus = None
+            if others:
+                othersConsensus = consensusScore(others)[0]
+            driftBin = position * self.driftBins // max(self.counts.get(scorer, 1), 1)
+            for key, tally in [(scorer, self.byScorer), ((scorer, driftBin), self.drift)]:
+                if key not in tally:
+                    tally[key] = [0, 0, 0, 0.0, 0]
+                counts = tally[key]
+                counts[0] = counts[0] + 1
+                if othersConsensus is not None:
+                    counts[1] = counts[1] + 1
+                    if score == othersConsensus:
+                        counts[2] = counts[2] + 1
+                try:
+                    counts[3] = counts[3] + float(score)
+                    counts[4] = counts[4] + 1
+                except ValueError:
+                    pass
+        # Every pair of scorers of the well
+        names = sorted(scores.keys())
+        for i in range(len(names)):
+            for j in range(i + 1, len(names)):
+                confusion = self.pairs.setdefault( (names[i], names[j]), {} )
+                pair = (scores[names[i]][1], scores[names[j]][1])
+                confusion[pair] = confusion.get(pair, 0) + 1
+        if n > 1:
+            tally = {}
+            for score in given:
+                tally[score] = tally.get(score, 0) + 1
+            self.fleissSum = self.fleissSum + sum([k * (k - 1) for k in tally.values()]) / float(n * (n - 1))
+            self.fleissWells = self.fleissWells + 1
+            for score, k in tally.items():
+                self.fleissScores[score] = self.fleissScores.get(score, 0) + k
+        return consensus, fraction
+
+    def fleissKappa(self):
+        """
+        Returns Fleiss' kappa, or None if it isn't defined
+        """
+        if not self.fleissWells:
+            return None
+        ratings = float(sum(self.fleissScores.values()))
+        observed = self.fleissSum / self.fleissWells
+        expected = sum([(k / ratings) ** 2 for k in self.fleissScores.values()])
+        if expected == 1:
+            return None
+        return (observed - expected) / (1 - expected)
+
+    def scoreValues(self):
+        return sorted(self.scores.keys(), key=scoreOrder)
+
+    def scorerRows(self):
+        """
+        Rows of scorer, scores, wells, compared, agreement and mean score
+        """
+        rows = []
+        for scorer in self.scorers:
+            wells, compared, agreed, total, numeric = self.byScorer.get(scorer, [0, 0, 0, 0.0, 0])
+            rows.append([scorer, self.counts[scorer], wells, compared,
+                         ratio(agreed, compared), ratio(total, numeric)])
+        return rows
+
+    def pairRows(self):
+        """
+        Rows of scorer, scorer, wells, agreement and Cohen's kappa
+        """
+        rows = []
+        for (first, second), confusion in sorted(self.pairs.items()):
+            wells = sum(confusion.values())
+            agreed = sum([n for (a, b), n in confusion.items() if a == b])
+            rows.append([first, second, wells, ratio(agreed, wells),
+                         formatStat(cohensKappa(confusion))])
+        return rows
+
+    def driftRows(self):
+        """
+        Rows of scorer, bin, first and last position, wells, compared,
+        agreement and mean score
+        """
+        rows = []
+        for (scorer, driftBin), counts in sorted(self.drift.items()):
+            wells, compared, agreed, total, numeric = counts
+            count = self.counts[scorer]
+            first = (driftBin * count + self.driftBins - 1) // self.driftBins
+            last = ((driftBin + 1) * count + self.driftBins - 1) // self.driftBins
+            rows.append([scorer, driftBin + 1, first + 1, last, wells, compared,
+                         ratio(agreed, compared), ratio(total, numeric)])
+        return rows
+
+
+def formatStat(value):
+    if value is None:
+        return ""
+    return "%.3f" % value
+
+
+def ratio(numerator, denominator):
+    if not denominator:
+        return ""
+    return formatStat(numerator / float(denominator))
+
+
+scorerHeader = ["scorer", "scores", "wells", "compared", "agreement", "meanScore"]
+pairHeader = ["scorer1", "scorer2", "wells", "agreement", "kappa"]
+driftHeader = ["scorer", "bin", "firstScore", "lastScore", "wells", "compared",
+               "agreement", "meanScore"]
+
+
+def analyzeScores(scoreFiles, reportFile, driftBins = 10, runRows = 100000, tmpDir = None):
+    """
+    Joins score files on the well and writes how well the scorers
+    agree: a CSV of the consensus of each well, CSVs of the scorers,
+    pairs of scorers and drift, and an HTML report of them all with
+    the confusion matrix of each pair. The CSVs are named after the
+    report, e.g. agreement.html has agreement-consensus.csv.
+
+    Arguments:
+    - scoreFiles : list, score files as written by the plugin or by
+      dbexport, or "name=path" to name the scorer of a file (see
+      scorerNames)
+    - reportFile : string, the HTML report
+    - driftBins : integer, see AgreementStats
+    - runRows, tmpDir : see ScoreMerger
+
+    Returns the AgreementStats
+    """
+    base = os.path.splitext(reportFile)[0]
+    merger = ScoreMerger(scoreFiles, runRows, tmpDir=tmpDir)
+    merger.sort()
+    stats = AgreementStats(merger.counts, driftBins)
+    out = open(base + "-consensus.csv", "w")
+    writer = csv.writer(out, delimiter=",")
+    writer.writerow(["plate", "row", "col", "scores", "consensus", "agreement"] + stats.scorers)
+    for well, scores in merger.wells():
+        consensus, fraction = stats.add(scores)
+        if consensus is None:
+            consensus = ""
+        writer.writerow([i for i in well] + [len(scores), consensus, formatStat(fraction)] +
+                        [scores.get(scorer, (None, ""))[1] for scorer in stats.scorers])
+    out.close()
+    tables = [("scorers", scorerHeader, stats.scorerRows()),
+              ("pairs", pairHeader, stats.pairRows()),
+              ("drift", driftHeader, stats.driftRows())]
+    for name, header, rows in tables:
+        out = open("%s-%s.csv" % (base, name), "w")
+        writer = csv.writer(out, delimiter=",")
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+        out.close()
+    out = open(reportFile, "w")
+    out.write('<html>\n<head><meta charset="utf-8"><title>Scorer agreement</title></head>\n<body>\n')
+    wells = sum(stats.raters.values())
+    summary = ["%i score files, %i scorers, %i wells" % (len(scoreFiles), len(stats.scorers), wells),
+               "Wells by number of scores: %s" % ", ".join(
+                   ["%i: %i" % (n, stats.raters[n]) for n in sorted(stats.raters.keys())]),
+               "Wells with more than one score that have a consensus: %i" % stats.consensusWells,
+               "Fleiss' kappa: %s" % (formatStat(stats.fleissKappa()) or "not defined"),
+               link("Consensus of each well", os.path.basename(base + "-consensus.csv"))]
+    out.write("<h1>Scorer agreement</h1>\n")
+    out.write( str(List(summary)) )
+    titles = {"scorers" : "Agreement of each scorer with the others",
+              "pairs" : "Agreement of each pair of scorers",
+              "drift" : "Agreement and mean score of each scorer over time"}
+    for name, header, rows in tables:
+        out.write("<h2>%s</h2>\n" % titles[name])
+        Table(rows, header_row=header).write(out)
+        out.write("\n")
+    out.write("<h2>Confusion matrices</h2>\n")
+    values = stats.scoreValues()
+    for (first, second), confusion in sorted(stats.pairs.items()):
+        out.write("<h3>%s (rows) against %s (columns)</h3>\n" % (first, second))
+        rows = [[value] + [confusion.get((value, other), 0) for other in values] for value in values]
+        Table(rows, header_row=[""] + values).write(out)
+        out.write("\n")
+    out.write("</body>\n</html>\n")
+    out.close()
+    return stats
+
+
+def agreementCommand(argv):
+    parser = argparse.ArgumentParser(
+        prog="agreement",
+        description="Join score files on the well and measure how well the scorers agree")
+    parser.add_argument("reportFile", help="HTML report, the CSVs are written next to it")
+    parser.add_argument("scoreFiles", nargs="+",
+                        help="score files, or name=path to name the scorer. Each scorer is "
+                        "named after the end of the path of their file that no other file "
+                        "has, unless it has a scorer column")
+    parser.add_argument("--drift-bins", type=int, default=10,
+                        help="bins of each scorer's scores, in the order they were given")
+    parser.add_argument("--run-rows", type=int, default=100000,
+                        help="most scores sorted in memory at once")
+    parser.add_argument("--tmp-dir", default=None, help="folder for the sorted runs")
+    args = parser.parse_args(argv)
+    stats = analyzeScores(args.scoreFiles, args.reportFile, args.drift_bins,
+                          args.run_rows, args.tmp_dir)
+    print("%i scorers, %i wells, Fleiss' kappa %s" % (
+        len(stats.scorers), sum(stats.raters.values()),
+        formatStat(stats.fleissKappa()) or "not defined"))
+    print("Wrote %s" % args.reportFile)
 
 
 
@@ -759,25 +4772,50 @@ class ChangedMax(ActionListener):
         newValue = int(self.field.getText())
         plateGrid.setMinAndMax(maxVal = newValue)
 
+def showMinAndMax(minField, maxField):
+    """ Shows the min and max of the current image, which
+    may have been set automatically, in their fields"""
+    global plateGrid
+    if minField is not None:
+        minField.setValue(plateGrid.min)
+        maxField.setValue(plateGrid.max)
+
+def loadingProgress(label):
+    """ Returns a function that shows how many plates have been
+    loaded in label. It can be called from any thread."""
+    def progress(done, total):
+        if done < total:
+            text = "Loading plates: %i of %i" % (done, total)
+        else:
+            text = "All %i plates loaded" % total
+        SwingUtilities.invokeLater(lambda: label.setText(text))
+    return progress
+
 class NextImage(ActionListener):
-    def __init__(self, field):
+    def __init__(self, field, minField = None, maxField = None):
         self.scoreField = field
+        self.minField = minField
+        self.maxField = maxField
     def actionPerformed(self, event):
         global plateGrid
         global frame
         score = plateGrid.openNext()
         if score is not None:
             self.scoreField.setText(score)
+            showMinAndMax(self.minField, self.maxField)
             frame.setVisible(True)
 
 class PreviousImage(ActionListener):
-    def __init__(self, field):
+    def __init__(self, field, minField = None, maxField = None):
         self.scoreField = field
+        self.minField = minField
+        self.maxField = maxField
     def actionPerformed(self, event):
         global plateGrid
         global frame
         score = plateGrid.openPrevious()
         self.scoreField.setText(score)
+        showMinAndMax(self.minField, self.maxField)
         frame.setVisible(True)
 
 class WriteScore(ActionListener):
@@ -805,68 +4843,149 @@ class Closing(WindowAdapter):
 #####                       Main code                                 #####
 ###########################################################################
 
-# Set up the fields for the SWING interface
-minField = JFormattedTextField( 0 )
-minField.addActionListener( ChangedMin(minField) )
+def runGUI():
+    """
+    Asks for the grids and the score file and opens the scoring window
+    """
+    global plateGrid
+    global frame
+    # Set up the fields for the SWING interface
+    minField = JFormattedTextField( 0 )
+    minField.addActionListener( ChangedMin(minField) )
 
-maxField = JFormattedTextField( 255 )
-maxField.addActionListener( ChangedMax(maxField) )
+    maxField = JFormattedTextField( 255 )
+    maxField.addActionListener( ChangedMax(maxField) )
 
-scoreField = JTextField( "" )
-scoreField.addActionListener( NextImage(scoreField) )
-scoreField.addActionListener( WriteScore(scoreField) )
+    scoreField = JTextField( "" )
+    scoreField.addActionListener( NextImage(scoreField, minField, maxField) )
+    scoreField.addActionListener( WriteScore(scoreField) )
 
-button = JButton("Previous image")
-button.addActionListener( PreviousImage(scoreField) )
+    button = JButton("Previous image")
+    button.addActionListener( PreviousImage(scoreField, minField, maxField) )
 
     # Pack all the fields into a JPanel
-all = JPanel()
-layout = GridLayout(4, 1)
-all.setLayout(layout)
-all.add( JLabel("  ") )
-all.add( button )
-all.add( JLabel("Min") )
-all.add( minField )
-all.add( JLabel("Max") )
-all.add(maxField )
-all.add( JLabel("Score :") )
-all.add(scoreField)
-frame = JFrame("CCM scoring")
-frame.getContentPane().add(JScrollPane(all))
-frame.pack()
-frame.addWindowListener( Closing() )
-scoreField.requestFocusInWindow()
-
-# Get the grid files
-chooser = JFileChooser()
-chooser.setDialogTitle("Choose plate grids")
-chooser.setMultiSelectionEnabled(True)
-chooser.setCurrentDirectory( File(os.path.expanduser("~")))
-chooser.showOpenDialog(JPanel())
-
-# This is a hack to get a file path from the
-# sun.awt.shell.DefaultShellFolder object returned by the chooser
-fp = [str(i) for i in chooser.getSelectedFiles()]
-
-if len(fp) != 0:
-    gd = GenericDialog("Name your output file")
-    gd.addStringField("Score file name", "scores.csv")
-    gd.showDialog()
-    if not gd.wasCanceled():
-        scoreFile = gd.getNextString()
-        scoreFile = os.path.join( os.path.split(fp[0])[0], scoreFile)
-        cropDir = os.path.splitext( scoreFile)[0] + "_cropped"
-        # Initialize the grid readers
-        plateGrid = GridSet(fp,scoreFile,cropDir)
+    loadingLabel = JLabel("  ")
+
+    all = JPanel()
+    layout = GridLayout(5, 2)
+    all.setLayout(layout)
+    all.add( JLabel("  ") )
+    all.add( button )
+    all.add( JLabel("Min") )
+    all.add( minField )
+    all.add( JLabel("Max") )
+    all.add(maxField )
+    all.add( JLabel("Score :") )
+    all.add(scoreField)
+    all.add( JLabel("  ") )
+    all.add( loadingLabel )
+    frame = JFrame("CCM scoring")
+    frame.getContentPane().add(JScrollPane(all))
+    frame.pack()
+    frame.addWindowListener( Closing() )
+    scoreField.requestFocusInWindow()
+
+    # Get the grid files
+    chooser = JFileChooser()
+    chooser.setDialogTitle("Choose plate grids")
+    chooser.setMultiSelectionEnabled(True)
+    chooser.setCurrentDirectory( File(os.path.expanduser("~")))
+    chooser.showOpenDialog(JPanel())
+
+    # This is a hack to get a file path from the
+    # sun.awt.shell.DefaultShellFolder object returned by the chooser
+    fp = [str(i) for i in chooser.getSelectedFiles()]
+
+    if len(fp) == 1 and fp[0].endswith(".session"):
+        # Pick up a session where it was left
+        plateGrid = resumeSession(fp[0])
+        plateGrid.loadPlates(progress=loadingProgress(loadingLabel))
         plateGrid.openNext()
-        # Show the GUI
+        showMinAndMax(minField, maxField)
         frame.setVisible(True)
+    elif len(fp) != 0:
+        gd = GenericDialog("Name your output file")
+        gd.addStringField("Score file name", "scores.csv")
+        gd.addStringField("Score database (optional)", "")
+        gd.addStringField("Scorer", userName())
+        gd.addNumericField("Image memory in MB (0 for no limit)", 0, 0)
+        gd.addChoice("Order", ["random", "blocked"], "random")
+        gd.addNumericField("Images per block", 4, 0)
+        gd.addChoice("Contrast", ["manual", "plate", "well"], "manual")
+        gd.addChoice("Thumbnails", ["one per well", "sheets by plate", "sheets by score"], "one per well")
+        gd.addNumericField("Thumbnail size (0 for the size of the cell)", 300, 0)
+        gd.addChoice("Thumbnail format", ["jpeg", "png"], "jpeg")
+        gd.addNumericField("JPEG quality", 85, 0)
+        gd.addCheckbox("Keep full size cells", False)
+        gd.addCheckbox("Record timings", False)
+        gd.showDialog()
+        if not gd.wasCanceled():
+            scoreFile = gd.getNextString()
+            database = gd.getNextString().strip()
+            scorer = gd.getNextString().strip()
+            cacheMB = gd.getNextNumber()
+            blockSize = int(gd.getNextNumber())
+            order = gd.getNextChoice()
+            contrast = gd.getNextChoice()
+            sprites = {"one per well" : "well",
+                       "sheets by plate" : "plate",
+                       "sheets by score" : "score"}[ gd.getNextChoice() ]
+            thumbSize = int(gd.getNextNumber())
+            thumbFormat = gd.getNextChoice()
+            quality = int(gd.getNextNumber())
+            full = gd.getNextBoolean()
+            timing = gd.getNextBoolean()
+            scoreFile = os.path.join( os.path.split(fp[0])[0], scoreFile)
+            cropDir = os.path.splitext( scoreFile)[0] + "_cropped"
+            if database:
+                database = os.path.join( os.path.split(fp[0])[0], database)
+            # Initialize the grid readers
+            plateGrid = GridSet(fp,scoreFile,cropDir, cacheMB=cacheMB,
+                                order=order, blockSize=blockSize,
+                                contrast=contrast, database=database,
+                                scorer=scorer, timing=timing, sprites=sprites,
+                                thumbnailFormat=ThumbnailFormat(thumbSize, thumbFormat,
+                                                                quality, full))
+            # The other plates load while the first cell is shown
+            plateGrid.loadPlates(progress=loadingProgress(loadingLabel))
+            plateGrid.openNext()
+            showMinAndMax(minField, maxField)
+            # Show the GUI
+            frame.setVisible(True)
+        else:
+            pass
     else:
         pass
-else:
-    pass
 
 
 
+# Commands that can be run without the GUI, e.g.
+#   ImageJ-linux64 --headless --jython ccm-scoring_.py export outDir grids...
+#   ImageJ-linux64 --headless --jython ccm-scoring_.py features features.csv grids...
+#   ImageJ-linux64 --headless --jython ccm-scoring_.py fitgrid 4 6 400 images...
+#   ImageJ-linux64 --headless --jython ccm-scoring_.py dbexport scores.db scores.csv
+#   ImageJ-linux64 --headless --jython ccm-scoring_.py benchmark bench/ --wells 96 1536
+#   ImageJ-linux64 --headless --jython ccm-scoring_.py agreement agreement.html scores/*.csv
+# and all but features and fitgrid also run in python with NumPy and Pillow:
+#   python ccm-scoring_.py export outDir grids... --backend numpy
+commands = {
+    "export" : exportCommand,
+    "features" : featuresCommand,
+    "fitgrid" : fitGridCommand,
+    "dbexport" : dbExportCommand,
+    "benchmark" : benchmarkCommand,
+    "agreement" : agreementCommand,
+    }
 
+def runCommand(argv):
+    commands[ argv[0] ]( argv[1:] )
 
+
+if __name__ in ["__main__", "__builtin__"]:
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        runCommand(sys.argv[1:])
+    elif haveImageJ:
+        runGUI()
+    else:
+        print("usage: python ccm-scoring_.py {%s} ..." % ",".join(sorted(commands.keys())))
+        print("Scoring in a window needs Fiji")